@@ -0,0 +1,264 @@
+#----------------------------------------------------------------------------#
+# Statements and serialization for the JSON API (/api/v1).
+#
+# Every resource is a Core SELECT of just the requested fields, so rows come
+# back as plain tuples; they are zipped with the field names and encoded by
+# orjson (or json when it is not installed) without building ORM objects.
+# The builders only need the table metadata, so the same statements can be
+# executed by any engine or session.
+#----------------------------------------------------------------------------#
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import date, timezone
+
+import dateutil.parser
+from sqlalchemy import case, func, select, tuple_
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# fields that are not columns of the row and take a statement of their own
+EXTRAS = ('genres', 'past_shows', 'upcoming_shows')
+
+# what the HTML listings show, returned when ?fields= is not given
+LIST_FIELDS = {
+    'venues': ['id', 'name', 'city', 'state', 'num_upcoming_shows'],
+    'artists': ['id', 'name', 'num_upcoming_shows'],
+    'shows': ['venue_id', 'venue_name', 'artist_id', 'artist_name',
+              'artist_image_link', 'start_time'],
+}
+
+
+class Statements(object):
+
+    def __init__(self, metadata):
+        tables = metadata.tables
+        venue, artist, show = tables['venue'], tables['artist'], tables['show']
+        city, state, address = tables['city'], tables['state'], tables['address']
+        self.tables = tables
+        self.bases = {'venues': venue, 'artists': artist, 'shows': show}
+        # keyset pagination order; the key columns lead every list row
+        self.keys = {
+            'venues': [venue.c.id],
+            'artists': [artist.c.id],
+            'shows': [show.c.start_time, show.c.id],
+        }
+        # optional joins, taken only when a requested field needs the table
+        self.joins = {
+            'venues': [(city, venue.c.city_id == city.c.id),
+                       (state, venue.c.state_id == state.c.id),
+                       (address, venue.c.address_id == address.c.id)],
+            'artists': [(city, artist.c.city_id == city.c.id),
+                        (state, artist.c.state_id == state.c.id)],
+            'shows': [(venue, show.c.venue_id == venue.c.id),
+                      (artist, show.c.artist_id == artist.c.id)],
+        }
+
+        def owner(table, seeking):
+            fields = [
+                ('id', table.c.id), ('name', table.c.name),
+                ('city', city.c.name), ('state', state.c.name),
+            ]
+            if table is venue:
+                fields.append(('address', address.c.name))
+            fields += [
+                ('phone', table.c.phone), ('website', table.c.website),
+                ('facebook_link', table.c.facebook_link), ('image_link', table.c.image_link),
+                (seeking, table.c[seeking]), ('seeking_description', table.c.seeking_description),
+                ('num_upcoming_shows', table.c.upcoming_shows_count),
+                ('num_past_shows', table.c.past_shows_count),
+                ('updated_at', table.c.updated_at),
+            ]
+            return fields
+
+        fields = {
+            'venues': owner(venue, 'seeking_talent'),
+            'artists': owner(artist, 'seeking_venue'),
+            'shows': [
+                ('id', show.c.id),
+                ('start_time', show.c.start_time), ('end_time', show.c.end_time),
+                ('venue_id', show.c.venue_id), ('venue_name', venue.c.name),
+                ('venue_image_link', venue.c.image_link),
+                ('artist_id', show.c.artist_id), ('artist_name', artist.c.name),
+                ('artist_image_link', artist.c.image_link),
+            ],
+        }
+        self.fields = dict(
+            (entity, OrderedDict((name, column.label(name)) for name, column in columns))
+            for entity, columns in fields.items())
+
+    def parse_fields(self, entity, value, detail=False):
+        """Validate a ?fields= value; None or '' means the default set."""
+        allowed = list(self.fields[entity])
+        if entity != 'shows':
+            allowed += EXTRAS if detail else ['genres']
+        if not value:
+            return allowed if detail else LIST_FIELDS[entity]
+        fields = [field.strip() for field in value.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in allowed]
+        if unknown:
+            raise ValueError('unknown fields: ' + ', '.join(unknown))
+        return list(OrderedDict.fromkeys(fields))
+
+    def columns(self, entity, fields):
+        return [self.fields[entity][field] for field in fields if field not in EXTRAS]
+
+    def joined(self, entity, columns):
+        needed = set(column.element.table for column in columns)
+        source = self.bases[entity]
+        for table, onclause in self.joins[entity]:
+            if table in needed:
+                source = source.join(table, onclause)
+        return source
+
+    def listing(self, entity, fields, after=None, before=None, limit=50):
+        """One page of `entity` in key order, plus one row to detect a next page."""
+        key = self.keys[entity]
+        columns = self.columns(entity, fields)
+        stmt = select([column.label('_k{}'.format(i)) for i, column in enumerate(key)] + columns) \
+            .select_from(self.joined(entity, columns))
+        bound = tuple_(*key) if len(key) > 1 else key[0]
+        if before is not None:
+            stmt = stmt.where(bound < (before if len(key) > 1 else before[0])) \
+                .order_by(*[column.desc() for column in key])
+        else:
+            if after is not None:
+                stmt = stmt.where(bound > (after if len(key) > 1 else after[0]))
+            stmt = stmt.order_by(*key)
+        return stmt.limit(limit + 1)
+
+    def detail(self, entity, id, fields):
+        base = self.bases[entity]
+        columns = self.columns(entity, fields)
+        return select([base.c.id.label('_k0')] + columns) \
+            .select_from(self.joined(entity, columns)).where(base.c.id == id)
+
+    def search(self, entity, term, fields, limit, dialect):
+        # same matching and ranking as the HTML search; rows lead with (id, total)
+        base = self.bases[entity]
+        term = term.strip()
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        ranking = [case((base.c.name.ilike(pattern[1:], escape='\\'), 0), else_=1)]
+        if dialect == 'postgresql':
+            ranking.append(func.similarity(base.c.name, term).desc())
+        ranking += [func.length(base.c.name), base.c.name]
+        columns = self.columns(entity, fields)
+        return select([base.c.id.label('_k0'), func.count().over().label('_total')] + columns) \
+            .select_from(self.joined(entity, columns)) \
+            .where(base.c.name.ilike(pattern, escape='\\')) \
+            .order_by(*ranking).limit(limit)
+
+    def genres(self, entity, ids):
+        links = self.tables['venue_genres' if entity == 'venues' else 'artist_genres']
+        genre = self.tables['genre']
+        owner = links.c.venue_id if entity == 'venues' else links.c.artist_id
+        return select([owner, genre.c.name]) \
+            .select_from(links.join(genre, links.c.genre_id == genre.c.id)) \
+            .where(owner.in_(ids)).order_by(owner, genre.c.name)
+
+    def partners(self, entity):
+        """(partner table, its prefix, owner column, partner column) of the shows
+        of a venue (with their artists) or an artist (with their venues)."""
+        show = self.tables['show']
+        if entity == 'venues':
+            return self.tables['artist'], 'artist', show.c.venue_id, show.c.artist_id
+        return self.tables['venue'], 'venue', show.c.artist_id, show.c.venue_id
+
+    def partner_shows(self, entity, id, upcoming, now):
+        """The shows of a venue (with their artists) or an artist (with their venues)."""
+        show = self.tables['show']
+        partner, prefix, owner, partner_id = self.partners(entity)
+        when = show.c.start_time > now if upcoming else show.c.start_time < now
+        return select([partner.c.id.label(prefix + '_id'),
+                       partner.c.name.label(prefix + '_name'),
+                       partner.c.image_link.label(prefix + '_image_link'),
+                       show.c.start_time]) \
+            .select_from(show.join(partner, partner_id == partner.c.id)) \
+            .where(owner == id).where(when) \
+            .order_by(show.c.start_time, show.c.id)
+
+    def changed(self, tables):
+        """One row of the latest updated_at of each table and the time a row
+        of any of them was last deleted; the newest of these dates the lists."""
+        deletion = self.tables['deletion']
+        stamps = [select([func.max(self.tables[name].c.updated_at)]).scalar_subquery()
+                  for name in tables]
+        stamps.append(select([func.max(deletion.c.deleted_at)])
+                      .where(deletion.c.table_name.in_(tables)).scalar_subquery())
+        return select(stamps)
+
+    def changed_partners(self, entity, id):
+        """The updated_at of a venue or an artist and the latest of its partners',
+        whose names and images its page shows; no row if it does not exist."""
+        base = self.bases[entity]
+        show = self.tables['show']
+        partner, prefix, owner, partner_id = self.partners(entity)
+        return select([base.c.updated_at, func.max(partner.c.updated_at)]) \
+            .select_from(base.outerjoin(show, owner == base.c.id)
+                         .outerjoin(partner, partner_id == partner.c.id)) \
+            .where(base.c.id == id).group_by(base.c.id, base.c.updated_at)
+
+
+def records(fields, rows, width):
+    """Dicts of the requested column fields, skipping the `width` leading key columns."""
+    names = [field for field in fields if field not in EXTRAS]
+    return [dict(zip(names, row[width:])) for row in rows]
+
+
+def add_genres(items, ids, rows):
+    names = {}
+    for owner, name in rows:
+        names.setdefault(owner, []).append(name)
+    for item, id in zip(items, ids):
+        item['genres'] = names.get(id, [])
+
+
+def paginate(rows, limit, after, before, width):
+    """Trim the extra row of a listing and work out the cursors around the page."""
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if before:
+        rows.reverse()
+    prev_cursor = next_cursor = None
+    if rows:
+        if (has_more if before else after):
+            prev_cursor = encode_cursor(rows[0][:width])
+        if before or has_more:
+            next_cursor = encode_cursor(rows[-1][:width])
+    return rows, prev_cursor, next_cursor
+
+
+def encode_cursor(key):
+    raw = json.dumps([value.isoformat() if isinstance(value, date) else value for value in key])
+    return urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(entity, cursor):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        if entity == 'shows':
+            start_time = dateutil.parser.parse(values[0])
+            if start_time.tzinfo is None:
+                start_time = start_time.replace(tzinfo=timezone.utc)
+            return start_time, int(values[1])
+        return (int(values[0]),)
+    except (TypeError, ValueError, IndexError, KeyError, OverflowError):
+        # binascii and JSON decoding errors are ValueErrors too; callers
+        # only ever see the one message
+        raise ValueError('bad cursor')
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode()
@@ -2,19 +2,45 @@
 # Imports
 #----------------------------------------------------------------------------#
 
+import csv
+import gzip
+import io
 import json
+import hashlib
+import os
+import time
 import dateutil.parser
 import babel
+import babel.dates
 import sys
-import datetime
 import logging
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify
+import click
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from itertools import chain, groupby, islice
+from threading import Lock, Thread
+from functools import lru_cache, wraps
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort, stream_with_context, session, make_response, g
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import DDL, and_, case, event, func, or_, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload
 from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
+from lookups import LookupCache, upsert_names
+from routing import RoutingSQLAlchemy, replica_reads
+from importer import ENTITIES, Importer, read_records
+from cache import ResponseCache, make_backend
+from autocomplete import Autocomplete
+from instrumentation import SQLInstrumentation
+from metrics import Metrics
+from profiling import RequestProfiler
+from tracing import Tracer, span, traced
+from memory import MemoryDiagnostics
+from api import Statements, add_genres, decode_cursor, dumps, paginate, records
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
@@ -22,28 +48,60 @@ from forms import *
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
+sql_instrumentation = SQLInstrumentation(app)
+profiler = RequestProfiler(app)
+tracer = Tracer(app, db, authorize=profiler.authorized)
+memory_diagnostics = MemoryDiagnostics(app, db, authorize=profiler.authorized)
+profiler.exempt_blueprints.update(('traces', 'memory'))
 
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
 
+def utcnow():
+  return datetime.now(timezone.utc)
+
+def toUTC(value):
+  # naive timestamps (form input, legacy strings) are taken to be UTC
+  if isinstance(value, str):
+    value = dateutil.parser.parse(value)
+  if value is not None and value.tzinfo is None:
+    value = value.replace(tzinfo=timezone.utc)
+  return value
+
 class Show(db.Model):
     __tablename__ = 'show'
 
     id = db.Column(db.Integer, primary_key=True)
     artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'), nullable=False)
     venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'), nullable=False)
-    start_time = db.Column(db.String, nullable=False)
+    start_time = db.Column(db.DateTime(timezone=True), nullable=False)
+    end_time = db.Column(db.DateTime(timezone=True), nullable=False)
+    # which of the venue/artist counters this show is currently counted in
+    counted_as_upcoming = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+      default=utcnow, onupdate=utcnow, server_default=func.now())
 
     venue = db.relationship("Venue", backref=db.backref("shows", lazy=True))
     artist = db.relationship("Artist", backref=db.backref("shows", lazy=True))
 
-    def __init__(self, artist=None, venue=None, start_time=None):
+    __table_args__ = (
+      db.Index('ix_show_venue_id_start_time', 'venue_id', 'start_time'),
+      db.Index('ix_show_artist_id_start_time', 'artist_id', 'start_time'),
+      db.Index('ix_show_start_time_id', 'start_time', 'id'),
+      db.Index('ix_show_rollover', 'start_time',
+        postgresql_where=db.text('counted_as_upcoming')),
+      db.CheckConstraint('end_time > start_time', name='ck_show_end_after_start'),
+    )
+
+    def __init__(self, artist=None, venue=None, start_time=None, end_time=None):
       self.artist = artist
       self.venue =  venue
-      self.start_time = start_time
+      self.start_time = toUTC(start_time)
+      self.end_time = toUTC(end_time) if end_time is not None else \
+        self.start_time + timedelta(minutes=app.config['SHOW_DURATION_MINUTES'])
 
     def __repr__(self):
       return f'<Show: { self.artist.name } at { self.venue.name }>'
@@ -52,7 +110,7 @@ class Address(db.Model):
     __tablename__ = 'address'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, unique=True)
     venues = db.relationship('Venue', backref='address', lazy=True)
 
     def __init__(self, name=None):
@@ -65,7 +123,7 @@ class City(db.Model):
     __tablename__ = 'city'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, unique=True)
     venues = db.relationship('Venue', backref='city', lazy=True)
     artists = db.relationship('Artist', backref='city', lazy=True)
 
@@ -79,7 +137,7 @@ class Genre(db.Model):
     __tablename__ = 'genre'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False, unique=True)
 
     def __repr__(self):
       return self.name
@@ -88,7 +146,7 @@ class State(db.Model):
     __tablename__ = 'state'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, unique=True)
     venues = db.relationship('Venue', backref='state', lazy=True)
     artists = db.relationship('Artist', backref='state', lazy=True)
 
@@ -100,12 +158,14 @@ class State(db.Model):
 
 venue_genres = db.Table('venue_genres',
     db.Column('venue_id', db.Integer, db.ForeignKey('venue.id')),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id'))
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id')),
+    db.UniqueConstraint('venue_id', 'genre_id', name='uq_venue_genres')
 )
 
 artist_genres = db.Table('artist_genres',
     db.Column('artist_id', db.Integer, db.ForeignKey('artist.id')),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id'))
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id')),
+    db.UniqueConstraint('artist_id', 'genre_id', name='uq_artist_genres')
 )
 
 class Venue(db.Model):
@@ -122,10 +182,19 @@ class Venue(db.Model):
   website = db.Column(db.String(120))
   seeking_talent = db.Column(db.Boolean())
   seeking_description = db.Column(db.Text())
+  upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  past_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  updated_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+    default=utcnow, onupdate=utcnow, server_default=func.now())
   genres = db.relationship("Genre", secondary=venue_genres,
     backref=db.backref('venues', lazy=True))
   artists = db.relationship("Artist", secondary='show', viewonly=True)
 
+  __table_args__ = (
+    db.Index('ix_venue_name_trgm', 'name',
+      postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+  )
+
   def add_shows(self, items):
     for artist, start_time in items:
       self.shows.append(Show(venue=self, artist=artist, start_time=start_time))
@@ -147,10 +216,19 @@ class Artist(db.Model):
   website = db.Column(db.String(120))
   seeking_venue = db.Column(db.Boolean())
   seeking_description = db.Column(db.Text())
+  upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  past_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  updated_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+    default=utcnow, onupdate=utcnow, server_default=func.now())
   genres = db.relationship("Genre", secondary=artist_genres,
     backref=db.backref('artists', lazy=True))
   venues = db.relationship("Venue", secondary='show', viewonly=True)
 
+  __table_args__ = (
+    db.Index('ix_artist_name_trgm', 'name',
+      postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+  )
+
   def add_shows(self, items):
     for venue, start_time in items:
       self.shows.append(Show(venue=venue, artist=self, start_time=start_time))
@@ -158,111 +236,541 @@ class Artist(db.Model):
   def __repr__(self):
     return f'<Artist { self.name }>'
 
+class Deletion(db.Model):
+  # when a row of table_name was last deleted (see the list validators)
+  __tablename__ = 'deletion'
+
+  table_name = db.Column(db.String(64), primary_key=True)
+  deleted_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+#----------------------------------------------------------------------------#
+# Show counters.
+#----------------------------------------------------------------------------#
+
+# Venue/Artist.upcoming_shows_count and past_shows_count are maintained in the
+# same transaction as the show rows; `flask rollover-shows` moves shows from
+# upcoming to past as time passes and `flask reconcile-show-counts` repairs drift.
+
+@event.listens_for(Show, 'before_insert')
+def classifyShow(mapper, connection, show):
+  show.counted_as_upcoming = toUTC(show.start_time) > utcnow()
+
+@event.listens_for(db.session, 'after_flush')
+def countShows(session, flush_context):
+  deltas = Counter()
+  for show, delta in chain(((obj, 1) for obj in session.new),
+                           ((obj, -1) for obj in session.deleted)):
+    if isinstance(show, Show):
+      column = 'upcoming_shows_count' if show.counted_as_upcoming else 'past_shows_count'
+      deltas[(Venue, show.venue_id, column)] += delta
+      deltas[(Artist, show.artist_id, column)] += delta
+  applyShowCounts(session.connection(), deltas)
+
+def applyShowCounts(connection, deltas):
+  for (model, id, column), delta in deltas.items():
+    if delta:
+      table = model.__table__
+      connection.execute(table.update().where(table.c.id == id)
+        .values({column: table.c[column] + delta}))
+
+def rolloverShows(now, batch_size=1000):
+  moved = 0
+  while True:
+    rows = db.session.query(Show.id, Show.venue_id, Show.artist_id) \
+      .filter(Show.counted_as_upcoming, Show.start_time <= now) \
+      .limit(batch_size).with_for_update().all()
+    if not rows:
+      return moved
+    deltas = Counter()
+    for _, venue_id, artist_id in rows:
+      for key in ((Venue, venue_id), (Artist, artist_id)):
+        deltas[key + ('upcoming_shows_count',)] -= 1
+        deltas[key + ('past_shows_count',)] += 1
+    db.session.query(Show).filter(Show.id.in_([row.id for row in rows])) \
+      .update({Show.counted_as_upcoming: False}, synchronize_session=False)
+    applyShowCounts(db.session.connection(), deltas)
+    db.session.commit()
+    moved += len(rows)
+
+def reconcileShowCounts(now):
+  # returns how many venue and artist rows had drifted
+  drifted = 0
+  for model, show_key in ((Venue, Show.venue_id), (Artist, Show.artist_id)):
+    def countOf(*criteria):
+      return db.session.query(func.count(Show.id)) \
+        .filter(show_key == model.id, *criteria).scalar_subquery()
+    upcoming = countOf(Show.start_time > now)
+    past = countOf(Show.start_time <= now)
+    drifted += db.session.query(model) \
+      .filter(or_(model.upcoming_shows_count != upcoming, model.past_shows_count != past)) \
+      .update({model.upcoming_shows_count: upcoming, model.past_shows_count: past},
+        synchronize_session=False)
+  db.session.query(Show).update({Show.counted_as_upcoming: Show.start_time > now},
+    synchronize_session=False)
+  db.session.commit()
+  return drifted
+
+#----------------------------------------------------------------------------#
+# Bookings.
+#----------------------------------------------------------------------------#
+
+# No show lasts longer than SHOW_MAX_DURATION_MINUTES (the form and
+# import-data turn longer ones away), so a show that clashes with a new
+# [start_time, end_time) starts at most that long before start_time: a range
+# of ix_show_{venue,artist}_id_start_time, whatever the shows already stored
+# overlap among themselves (they may, where the exclusion constraints could
+# not be added or data came in through import-data). On Postgres those
+# constraints also turn away whatever slips past this check concurrently.
+
+# The ex_show_{venue,artist}_id_overlap exclusion constraints are Postgres
+# only: db.create_all() adds them there (as does migration f3a8c1d6e290),
+# elsewhere nothing but bookingConflict keeps concurrent bookings apart.
+event.listen(Show.__table__, 'before_create',
+  DDL('CREATE EXTENSION IF NOT EXISTS btree_gist').execute_if(dialect='postgresql'))
+for column in ('venue_id', 'artist_id'):
+  event.listen(Show.__table__, 'after_create',
+    DDL('ALTER TABLE show ADD CONSTRAINT ex_show_{0}_overlap '
+        'EXCLUDE USING gist ({0} WITH =, tstzrange(start_time, end_time) WITH &&)'
+        .format(column)).execute_if(dialect='postgresql'))
+
+def isDoubleBooking(err):
+  # a violated exclusion constraint, as opposed to e.g. a foreign key
+  return getattr(err.orig, 'pgcode', None) == '23P01' or 'ex_show_' in str(err.orig)
+
+def bookingConflict(column, id, start_time, end_time):
+  earliest = start_time - timedelta(minutes=app.config['SHOW_MAX_DURATION_MINUTES'])
+  return db.session.query(Show.id, Show.start_time, Show.end_time) \
+    .filter(column == id, Show.start_time >= earliest, Show.start_time < end_time,
+      Show.end_time > start_time) \
+    .order_by(Show.start_time).first()
+
+def bookingConflicts(column, limit):
+  # one ordered pass per venue/artist finds the shows starting before an
+  # earlier one has ended; only those are joined back to their partners
+  ended = func.max(Show.end_time).over(partition_by=column,
+    order_by=(Show.start_time, Show.id), rows=(None, -1))
+  shows = db.session.query(Show.id, column.label('owner_id'), Show.start_time,
+    Show.end_time, ended.label('ended')).subquery()
+  other = aliased(Show)
+  return db.session.query(shows.c.owner_id, shows.c.id, shows.c.start_time, shows.c.end_time,
+      other.id, other.start_time, other.end_time) \
+    .join(other, and_(getattr(other, column.key) == shows.c.owner_id,
+      tuple_(other.start_time, other.id) < tuple_(shows.c.start_time, shows.c.id),
+      other.end_time > shows.c.start_time)) \
+    .filter(shows.c.ended > shows.c.start_time) \
+    .order_by(shows.c.owner_id, shows.c.start_time, other.start_time).limit(limit).all()
+
+#----------------------------------------------------------------------------#
+# Lookups.
+#----------------------------------------------------------------------------#
+
+lookups = LookupCache(maxsizes={'address': app.config['ADDRESS_CACHE_SIZE']})
+LOOKUP_MODELS = (City, State, Address, Genre)
+
+def warmLookups(model):
+  table = model.__tablename__
+  rows = db.session.query(model.name, model.id).order_by(model.id.desc())
+  if table in lookups.maxsizes:
+    rows = rows.limit(lookups.maxsizes[table])
+  lookups.warm(table, reversed(rows.all()))
+
+@traced('lookup', lambda model, names: {'lookup.table': model.__tablename__,
+  'lookup.names': len(names)})
+def dimensionIds(model, names):
+  table = model.__tablename__
+  if not lookups.is_warm(table):
+    # not warmed at startup (yet): the database was unreachable or the
+    # worker was forked while the warm-up thread was running
+    warmLookups(model)
+
+  ids = {}
+  for name in names:
+    id = lookups.get(table, name)
+    if id is not None:
+      ids[name] = id
+  missing = [name for name in names if name not in ids]
+  if missing:
+    upserted = upsert_names(db.session.connection(), model.__table__, missing)
+    ids.update(upserted)
+    # only cache the upserted rows once their transaction commits
+    db.session.info.setdefault('new_lookups', []).extend(
+      (table, name, id) for name, id in upserted.items())
+  return ids
+
+def dimensionId(model, name):
+  return dimensionIds(model, [name])[name]
+
+def genresNamed(names):
+  ids = list(dimensionIds(Genre, names).values())
+  return db.session.query(Genre).filter(Genre.id.in_(ids)).all() if ids else []
+
+@event.listens_for(db.session, 'after_commit')
+def cacheNewLookups(session):
+  for table, name, id in session.info.pop('new_lookups', ()):
+    lookups.put(table, name, id)
+    if table == 'city':
+      completions.add('city', id, name)
+
+@event.listens_for(db.session, 'after_rollback')
+def dropNewLookups(session):
+  session.info.pop('new_lookups', None)
+
+def assignChanged(obj, values):
+  # only touch attributes whose value differs, so an unchanged form is no UPDATE
+  changed = False
+  for key, value in values.items():
+    if getattr(obj, key) != value:
+      setattr(obj, key, value)
+      changed = True
+  return changed
+
+def syncGenres(owner, table, owner_column, genre_ids):
+  current = set(genre_id for genre_id, in db.session.execute(
+    select([table.c.genre_id]).where(owner_column == owner.id)))
+  wanted = set(genre_ids)
+  removed = current - wanted
+  added = wanted - current
+
+  if removed:
+    db.session.execute(table.delete().where(
+      and_(owner_column == owner.id, table.c.genre_id.in_(removed))))
+  if added:
+    db.session.execute(table.insert(),
+      [{owner_column.name: owner.id, "genre_id": genre_id} for genre_id in added])
+  if removed or added:
+    db.session.expire(owner, ['genres'])
+    owner.updated_at = utcnow()
+  return bool(removed or added)
+
+#----------------------------------------------------------------------------#
+# Page cache.
+#----------------------------------------------------------------------------#
+
+response_cache = ResponseCache(make_backend(app.config))
+
+def cachedPage(key, render):
+  # a page carrying flashed messages is neither served from nor stored in the cache
+  if '_flashes' in session:
+    return render()
+  html = response_cache.get(key)
+  status = 'HIT'
+  if html is None:
+    # render what gets stored from the primary: a page read from a lagging
+    # replica would outlive the invalidation of the write it missed, and be
+    # served to the writer too
+    g.read_replica = False
+    html = render()
+    response_cache.set(key, html)
+    status = 'MISS'
+  response = make_response(html)
+  response.headers['X-Cache'] = status
+  return response
+
+def showPartners(column, key_column, id):
+  return [partner for partner, in db.session.query(column).filter(key_column == id).distinct()]
+
+def invalidatePages(venue_ids=(), artist_ids=()):
+  response_cache.invalidate(*(['venue:{}'.format(id) for id in venue_ids] +
+    ['artist:{}'.format(id) for id in artist_ids]))
+
+#----------------------------------------------------------------------------#
+# Metrics.
+#----------------------------------------------------------------------------#
+
+with app.app_context():
+  metric_engines = {'primary': db.engine}
+for number, replica in enumerate(app.extensions['replicas'].replicas, 1):
+  metric_engines['replica{}'.format(number)] = replica.engine
+metrics = Metrics(app, engines=metric_engines, caches={'pages': response_cache, 'lookups': lookups},
+  authorize=profiler.authorized)
+
+#----------------------------------------------------------------------------#
+# Page builders.
+#----------------------------------------------------------------------------#
+
+# The read-only pages are built by generators that yield the statements they
+# need and are sent each result back; a page builder returns the template
+# and its context, a stamp builder (below) its stamp. runReads drives one on
+# the request's session; asgi.py drives the same builders on its async
+# engine, so both serve these pages from the same code and the same SQL.
+
+def runReads(reads):
+  try:
+    statement = next(reads)
+    while True:
+      statement = reads.send(db.session.execute(statement))
+  except StopIteration as done:
+    return done.value
+
+def renderPage(reads):
+  template, context = runReads(reads)
+  return render_template(template, **context)
+
+#----------------------------------------------------------------------------#
+# Conditional GET.
+#----------------------------------------------------------------------------#
+
+# A validator is a stamp builder: it returns (last_modified, key) for the
+# page about to be rendered, or None to skip the check; key folds in
+# whatever else the page depends on.
+# The stamps are statements of api.py, so asgi.py validates the API the same way.
+
+statements = Statements(db.metadata)
+
+def stampValidators(stamp):
+  # (etag, last_modified) of a validator's stamp
+  last_modified = toUTC(stamp[0] or datetime.fromtimestamp(0, timezone.utc)).replace(microsecond=0)
+  return hashlib.md5('{}|{}'.format(stamp[1], stamp[0]).encode()).hexdigest(), last_modified
+
+def conditional(validator):
+  def decorator(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      if '_flashes' in session:
+        response = make_response(view(*args, **kwargs))
+        response.cache_control.private = True
+        response.cache_control.no_store = True
+        return response
+      stamp = runReads(validator(*args, **kwargs))
+      if stamp is None:
+        return view(*args, **kwargs)
+
+      etag, last_modified = stampValidators(stamp)
+      if isFresh(etag, last_modified):
+        return stampResponse(Response(status=304), etag, last_modified)
+      return stampResponse(make_response(view(*args, **kwargs)), etag, last_modified)
+    return wrapper
+  return decorator
+
+def isFresh(etag, last_modified):
+  # whether the client's copy is current; If-None-Match wins over If-Modified-Since
+  if request.if_none_match:
+    return request.if_none_match.contains_weak(etag)
+  return request.if_modified_since is not None and \
+    last_modified <= toUTC(request.if_modified_since)
+
+def stampResponse(response, etag, last_modified):
+  response.set_etag(etag, weak=True)
+  response.last_modified = last_modified
+  response.cache_control.public = True
+  response.cache_control.no_cache = True
+  return response
+
+def newest(stamps):
+  stamps = [toUTC(stamp) for stamp in stamps if stamp]
+  return max(stamps) if stamps else None
+
+def venueStamp(venue_id):
+  # the page also shows the names and images of the artists playing there
+  row = (yield statements.changed_partners('venues', venue_id)).first()
+  return row and (newest(row), 'venue:{}'.format(venue_id))
+
+def artistStamp(artist_id):
+  row = (yield statements.changed_partners('artists', artist_id)).first()
+  return row and (newest(row), 'artist:{}'.format(artist_id))
+
+# A list page changes when a row is added or updated, which max(updated_at)
+# reads off its index, or deleted, which leaves no updated_at behind: the
+# deleting transaction records the time in the deletion table instead.
+
+DELETION_STAMPED = ('venue', 'artist', 'show')
+
+@event.listens_for(db.session, 'after_flush')
+def stampDeletions(session, flush_context):
+  tables = set(obj.__tablename__ for obj in session.deleted
+    if getattr(obj, '__tablename__', None) in DELETION_STAMPED)
+  now = utcnow()
+  connection = session.connection()
+  table = Deletion.__table__
+  for name in sorted(tables):
+    updated = connection.execute(table.update()
+      .where(table.c.table_name == name).values(deleted_at=now)).rowcount
+    if not updated:
+      # the migration adds the rows; a database made with create_all() lacks them
+      connection.execute(table.insert().values(table_name=name, deleted_at=now))
+
+def latestChange(*models):
+  row = (yield statements.changed([model.__tablename__ for model in models])).one()
+  return newest(row)
+
+def listStamp(model):
+  def stamp():
+    changed = yield from latestChange(model)
+    return changed, model.__tablename__
+  return stamp
+
+def showsStamp():
+  # the date, because presets and the calendar strip are relative to today
+  changed = yield from latestChange(Show, Venue, Artist)
+  return changed, 'shows:{}:{}'.format(utcnow().date(), request.query_string.decode())
+
+#----------------------------------------------------------------------------#
+# Search.
+#----------------------------------------------------------------------------#
+
+def searchPage(model):
+  # case-insensitive substring match, served by the trigram indexes on
+  # Postgres; prefix matches rank first, then trigram similarity
+  search_term = request.form.get('search_term', '')
+  term = search_term.strip()
+  pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+  ranking = [case([(model.name.ilike(pattern[1:], escape='\\'), 0)], else_=1)]
+  if db.engine.dialect.name == 'postgresql':
+    ranking.append(func.similarity(model.name, term).desc())
+  ranking += [func.length(model.name), model.name]
+
+  rows = (yield select([model.id, model.name, model.upcoming_shows_count, func.count().over()])
+    .where(model.name.ilike(pattern, escape='\\'))
+    .order_by(*ranking)
+    .limit(app.config['SEARCH_RESULTS_LIMIT'])).fetchall()
+
+  results = {
+    "count": rows[0][3] if rows else 0,
+    "data": [{
+      "id": id,
+      "name": name,
+      "num_upcoming_shows": num_upcoming_shows
+    } for id, name, num_upcoming_shows, _ in rows]
+  }
+  return 'pages/search_{}s.html'.format(model.__tablename__), \
+    {'results': results, 'search_term': search_term}
+
+#----------------------------------------------------------------------------#
+# Autocomplete.
+#----------------------------------------------------------------------------#
+
+completions = Autocomplete()
+COMPLETION_MODELS = {'venue': Venue, 'artist': Artist, 'city': City}
+
+def loadCompletions():
+  """(Re)build this worker's /autocomplete indexes from the database."""
+  with app.app_context():
+    for kind, model in COMPLETION_MODELS.items():
+      completions.load(kind, db.session.query(model.id, model.name).yield_per(10000))
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_datetime(date, format)
+DATETIME_FORMATS = {
+  'full': "EEEE MMMM, d, y 'at' h:mma",
+  'medium': "EE MM, dd, y h:mma"
+}
+
+@lru_cache(maxsize=None)
+def datetimePattern(format):
+  return babel.dates.parse_pattern(DATETIME_FORMATS.get(format, format))
+
+@lru_cache(maxsize=None)
+def datetimeLocale(locale):
+  return babel.Locale.parse(locale)
+
+def asDatetime(value):
+  date = value if isinstance(value, datetime) else dateutil.parser.parse(value)
+  if date.tzinfo is None:
+    date = date.replace(tzinfo=timezone.utc)
+  return date
+
+def format_datetime(value, format='medium', locale=None):
+  # same output as babel.dates.format_datetime with a pattern, without
+  # re-parsing the pattern and re-loading the locale data on every call
+  return datetimePattern(format).apply(asDatetime(value), datetimeLocale(locale or babel.dates.LC_TIME))
+
+def format_datetimes(values, format='medium', locale=None):
+  # a list at a time: looks the pattern and the locale up once
+  pattern = datetimePattern(format)
+  locale = datetimeLocale(locale or babel.dates.LC_TIME)
+  return [pattern.apply(asDatetime(value), locale) for value in values]
 
 app.jinja_env.filters['datetime'] = format_datetime
+app.jinja_env.filters['datetimes'] = format_datetimes
 
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
 
+def validated(form):
+  # form validation gets a span of its own in traces
+  with span('validate ' + type(form).__name__):
+    return form.validate_on_submit()
+
 @app.route('/')
 def index():
   return render_template('pages/home.html')
 
 
+@app.route('/autocomplete')
+def autocomplete():
+  prefix = request.args.get('q', '')
+  limit = request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT'], type=int)
+  limit = max(1, min(limit, app.config['AUTOCOMPLETE_MAX_LIMIT']))
+  kinds = request.args.get('kinds', 'venue,artist,city').split(',')
+  if any(kind not in COMPLETION_MODELS for kind in kinds):
+    abort(400)
+
+  data = {}
+  for kind in kinds:
+    data[kind] = [{"id": id, "name": name}
+      for id, name in (completions.complete(kind, prefix, limit) if prefix.strip() else [])]
+  return jsonify(data)
+
+
 #  Venues
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@replica_reads
+@conditional(listStamp(Venue))
 def venues():
+  return renderPage(venuesPage())
 
-  data = []
-  allVenues = db.session.query(City).join(Venue).join(State)
-  venues = allVenues.with_entities(City.id, City.name, State.name).distinct().all()
-  for venue in venues:
-    print(venue)
-  for city_id, city, state in venues:
-    theVenues = db.session.query(Venue).filter_by(city_id=city_id).all()
-    result = {"city": city, "state": state, "venues": []}
-    for venue in theVenues:
-      upcoming = db.session.query(Show).filter_by(venue_id = venue.id).filter(
-        Show.start_time > datetime.utcnow().isoformat()).all()
-      result["venues"].append({
-        "id": venue.id,
-        "name": venue.name,
-        "num_upcoming_shows": len(upcoming)
-      })
-    data.append(result)
-  return render_template('pages/venues.html', areas=data);
+def venuesPage():
+  rows = (yield select([City.name, State.name, Venue.id, Venue.name, Venue.upcoming_shows_count])
+    .select_from(Venue).join(City).join(State)
+    .order_by(City.name, State.name, Venue.name)).fetchall()
 
-@app.route('/venues/search', methods=['POST'])
-def search_venues():
-  searchTerm = request.form.get("search_term")
-  venues = db.session.query(Venue).with_entities(Venue.id, Venue.name).filter(Venue.name.contains(searchTerm)).all()
   data = []
-  for venue in venues:
-    upcoming = db.session.query(Show).filter_by(venue_id = venue.id).filter(
-      Show.start_time > datetime.utcnow().isoformat()).all()
+  for (city, state), venues in groupby(rows, key=lambda row: row[:2]):
     data.append({
-      "id": venue.id,
-      "name": venue.name,
-      "num_upcoming_shows": len(upcoming)
-    })
-  response={
-    "count": len(venues),
-    "data": data
-  }
-  return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
-
-def formartShows(shows_list):
-  new_list = []
-  for show in shows_list:
-    artist = show.artist
-    new_list.append({
-      "artist_id": artist.id,
-      "artist_name": artist.name,
-      "artist_image_link": artist.image_link,
-      "start_time": show.start_time
+      "city": city,
+      "state": state,
+      "venues": [{
+        "id": venue_id,
+        "name": name,
+        "num_upcoming_shows": num_upcoming_shows
+      } for _, _, venue_id, name, num_upcoming_shows in venues]
     })
-  return new_list
+  return 'pages/venues.html', {'areas': data}
+
+@app.route('/venues/search', methods=['POST'])
+@replica_reads
+def search_venues():
+  return renderPage(searchPage(Venue))
 
 @app.route('/venues/<int:venue_id>')
+@replica_reads
+@conditional(venueStamp)
 def show_venue(venue_id):
-  venue = db.session.query(Venue).filter_by(id = venue_id).first()
-  venue.city
-  venue.state
-  venue.address
-  
-  data = {}
-  if venue:
-    data = venue.__dict__
-    del data['_sa_instance_state']
-    
-    pastshows = db.session.query(Show).filter_by(venue_id = venue.id).filter(
-      Show.start_time < datetime.utcnow().isoformat()).all()
-    upcomingshows = db.session.query(Show).filter_by(venue_id = venue.id).filter(
-      Show.start_time > datetime.utcnow().isoformat()).all()
-
-    past_shows = formartShows(pastshows)
-    upcoming_shows = formartShows(upcomingshows)
-
-    data["past_shows"] = past_shows
-    data["upcoming_shows"] = upcoming_shows
-    data["past_shows_count"] = len(past_shows)
-    data["upcoming_shows_count"] = len(upcoming_shows)
-
-  return render_template('pages/show_venue.html', venue=data)
+  return cachedPage('venue:{}'.format(venue_id), lambda: renderPage(venuePage(venue_id)))
+
+def venuePage(venue_id):
+  return (yield from detailPage('venues', venue_id))
+
+def detailPage(entity, id):
+  # the venue or artist, its genres, and its shows with their artists or venues
+  fields = statements.parse_fields(entity, None, detail=True)
+  row = (yield statements.detail(entity, id, fields)).first()
+  if row is None:
+    abort(404)
+  data = records(fields, [row], 1)[0]
+  add_genres([data], [id], (yield statements.genres(entity, [id])))
+  now = utcnow()
+  for field, upcoming in (('past_shows', False), ('upcoming_shows', True)):
+    shows = yield statements.partner_shows(entity, id, upcoming, now)
+    data[field] = [dict(show._mapping) for show in shows]
+    data[field + '_count'] = len(data[field])
+  name = entity[:-1]
+  return 'pages/show_{}.html'.format(name), {name: data}
 
 #  Create Venue
 #  ----------------------------------------------------------------
@@ -277,34 +785,27 @@ def create_venue_submission():
   new_venue = Venue()
 
   form = VenueForm()
-  if not form.validate_on_submit():
+  if not validated(form):
     return render_template('forms/new_venue.html', form=form)
 
-  city = db.session.query(City).filter_by(name = request.form.get("city")).first()
-  if not city:
-    city = City(request.form.get("city"))
-  address = db.session.query(Address).filter_by(name = request.form.get("address")).first()
-  if not address:
-    address = Address(request.form.get("address"))
-  state = db.session.query(State).filter_by(name = request.form.get("state")).first()
-  if not state:
-    state = State(request.form.get("state"))
+  city_id = dimensionId(City, request.form.get("city"))
+  address_id = dimensionId(Address, request.form.get("address"))
+  state_id = dimensionId(State, request.form.get("state"))
 
   try:
-    genres = []
-    for genre in request.form.getlist("genres"):
-      genres.append(Genre(name=genre))
+    genres = genresNamed(request.form.getlist("genres"))
 
     new_venue.name = request.form.get("name")
-    new_venue.city = city
-    new_venue.state = state
-    new_venue.address = address
+    new_venue.city_id = city_id
+    new_venue.state_id = state_id
+    new_venue.address_id = address_id
     new_venue.phone = request.form.get("phone")
     new_venue.facebook_link = request.form.get("facebook_link")
     new_venue.genres = genres
 
     db.session.add(new_venue)
     db.session.commit()
+    completions.add('venue', new_venue.id, new_venue.name)
     flash('Venue ' + request.form['name'] + ' was successfully listed!')
   except Exception as err:
     flash('An error occurred. Venue ' + request.form['name'] + ' could not be listed.')
@@ -316,8 +817,12 @@ def delete_venue(venue_id):
   try:
     venue = db.session.query(Venue).filter_by(id = venue_id).first()
     venue_name = venue.name
+    venue_key = venue.id
+    artist_ids = showPartners(Show.artist_id, Show.venue_id, venue_key)
     db.session.delete(venue)
     db.session.commit()
+    invalidatePages(venue_ids=[venue_key], artist_ids=artist_ids)
+    completions.remove('venue', venue_key, venue_name)
     flash('Venue ' + venue_name + ' successfully deleted.')
   except Exception as err:
     flash('An error occurred. Venue with id ' + venue_id + ' could not be deleted.')
@@ -329,71 +834,28 @@ def delete_venue(venue_id):
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@replica_reads
+@conditional(listStamp(Artist))
 def artists():
-  data = db.session.query(Artist).with_entities(Artist.id, Artist.name).all()
-  return render_template('pages/artists.html', artists=data)
+  return renderPage(artistsPage())
+
+def artistsPage():
+  rows = (yield select([Artist.id, Artist.name])).fetchall()
+  return 'pages/artists.html', {'artists': rows}
 
 @app.route('/artists/search', methods=['POST'])
+@replica_reads
 def search_artists():
-  data = []
-  artists = []
-
-  searchTerm = request.form.get("search_term").lower()
-  for artist in db.session.query(Artist).with_entities(Artist.id, Artist.name).all():
-    if searchTerm in artist.name.lower():
-      artists.append(artist)
-
-  for artist in artists:
-    upcoming = db.session.query(Show).filter_by(artist_id = artist.id).filter(
-      Show.start_time > datetime.utcnow().isoformat()).all()
-    data.append({
-      "id": artist.id,
-      "name": artist.name,
-      "num_upcoming_shows": len(upcoming)
-    })
-  response={
-    "count": len(artists),
-    "data": data
-  }
-  return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
-
-def formartArtistShows(shows_list):
-  new_list = []
-  for show in shows_list:
-    venue = show.venue
-    new_list.append({
-      "venue_id": venue.id,
-      "venue_name": venue.name,
-      "venue_image_link": venue.image_link,
-      "start_time": show.start_time
-    })
-  return new_list
+  return renderPage(searchPage(Artist))
 
 @app.route('/artists/<int:artist_id>')
+@replica_reads
+@conditional(artistStamp)
 def show_artist(artist_id):
-  artist = db.session.query(Artist).filter_by(id = artist_id).first()
-  artist.city
-  artist.state
-  
-  data = {}
-  if artist:
-    data = artist.__dict__
-    del data['_sa_instance_state']
-    
-    pastshows = db.session.query(Show).filter_by(artist_id = artist.id).filter(
-      Show.start_time < datetime.utcnow().isoformat()).all()
-    upcomingshows = db.session.query(Show).filter_by(artist_id = artist.id).filter(
-      Show.start_time > datetime.utcnow().isoformat()).all()
-
-    past_shows = formartArtistShows(pastshows)
-    upcoming_shows = formartArtistShows(upcomingshows)
+  return cachedPage('artist:{}'.format(artist_id), lambda: renderPage(artistPage(artist_id)))
 
-    data["past_shows"] = past_shows
-    data["upcoming_shows"] = upcoming_shows
-    data["past_shows_count"] = len(past_shows)
-    data["upcoming_shows_count"] = len(upcoming_shows)
-
-  return render_template('pages/show_artist.html', artist=data)
+def artistPage(artist_id):
+  return (yield from detailPage('artists', artist_id))
 
 #  Update
 #  ----------------------------------------------------------------
@@ -422,34 +884,35 @@ def edit_artist_submission(artist_id):
   artist = db.session.query(Artist).filter_by(id = artist_id).first()
 
   form = ArtistEditForm()
-  if not form.validate_on_submit():
+  if not validated(form):
     return render_template('forms/edit_artist.html', form=form, artist=artist)
 
-  city = db.session.query(City).filter_by(name = request.form.get("city")).first()
-  if not city:
-    city = City(request.form.get("city"))
-  state = db.session.query(State).filter_by(name = request.form.get("state")).first()
-  if not state:
-    state = State(request.form.get("state"))
+  city_id = dimensionId(City, request.form.get("city"))
+  state_id = dimensionId(State, request.form.get("state"))
 
   try:
-    genres = []
-    for genre in request.form.getlist("genres"):
-      genres.append(Genre(name=genre))
-
-    artist.name = request.form.get("name")
-    artist.city = city
-    artist.phone = request.form.get("phone")
-    artist.state = state
-    artist.facebook_link = request.form.get("facebook_link")
-    artist.genres = genres
-    artist.image_link = request.form.get("image_link")
-    artist.website = request.form.get("website")
-    artist.seeking_venue = int(request.form.get("seeking_venue"))
-    artist.seeking_description = request.form.get("seeking_description")
-
-    db.session.add(artist)
-    db.session.commit()
+    genre_ids = dimensionIds(Genre, request.form.getlist("genres")).values()
+
+    old_name = artist.name
+    changed = assignChanged(artist, {
+      "name": request.form.get("name"),
+      "city_id": city_id,
+      "phone": request.form.get("phone"),
+      "state_id": state_id,
+      "facebook_link": request.form.get("facebook_link"),
+      "image_link": request.form.get("image_link"),
+      "website": request.form.get("website"),
+      "seeking_venue": bool(int(request.form.get("seeking_venue"))),
+      "seeking_description": request.form.get("seeking_description")
+    })
+    if syncGenres(artist, artist_genres, artist_genres.c.artist_id, genre_ids):
+      changed = True
+
+    if changed:
+      db.session.commit()
+      invalidatePages(venue_ids=showPartners(Show.venue_id, Show.artist_id, artist_id),
+        artist_ids=[artist_id])
+      completions.rename('artist', artist_id, old_name, request.form.get("name"))
     flash('Artist ' + request.form['name'] + ' was successfully updated!')
   except Exception as err:
     flash('An error occurred. Artist ' + request.form['name'] + ' could not be updated.')
@@ -482,39 +945,37 @@ def edit_venue_submission(venue_id):
   venue = db.session.query(Venue).filter_by(id = venue_id).first()
 
   form = VenueEditForm()
-  if not form.validate_on_submit():
+  if not validated(form):
     return render_template('forms/edit_venue.html', form=form, venue=venue)
 
-  city = db.session.query(City).filter_by(name = request.form.get("city")).first()
-  if not city:
-    city = City(request.form.get("city"))
-  address = db.session.query(Address).filter_by(name = request.form.get("address")).first()
-  if not address:
-    address = Address(request.form.get("address"))
-  state = db.session.query(State).filter_by(name = request.form.get("state")).first()
-  if not state:
-    state = State(request.form.get("state"))
+  city_id = dimensionId(City, request.form.get("city"))
+  address_id = dimensionId(Address, request.form.get("address"))
+  state_id = dimensionId(State, request.form.get("state"))
 
   try:
-    genres = []
-    for genre in request.form.getlist("genres"):
-      genres.append(Genre(name=genre))
-
-    venue.name = request.form.get("name")
-    venue.city = city
-    venue.state = state
-    venue.address = address
-    venue.phone = request.form.get("phone")
-    venue.facebook_link = request.form.get("facebook_link")
-    venue.genres = genres
-    venue.image_link = request.form.get("image_link")
-    venue.website = request.form.get("website")
-    venue.seeking_talent = int(request.form.get("seeking_talent"))
-    venue.seeking_description = request.form.get("seeking_description")
-    print(venue.address)
-
-    db.session.add(venue)
-    db.session.commit()
+    genre_ids = dimensionIds(Genre, request.form.getlist("genres")).values()
+
+    old_name = venue.name
+    changed = assignChanged(venue, {
+      "name": request.form.get("name"),
+      "city_id": city_id,
+      "state_id": state_id,
+      "address_id": address_id,
+      "phone": request.form.get("phone"),
+      "facebook_link": request.form.get("facebook_link"),
+      "image_link": request.form.get("image_link"),
+      "website": request.form.get("website"),
+      "seeking_talent": bool(int(request.form.get("seeking_talent"))),
+      "seeking_description": request.form.get("seeking_description")
+    })
+    if syncGenres(venue, venue_genres, venue_genres.c.venue_id, genre_ids):
+      changed = True
+
+    if changed:
+      db.session.commit()
+      invalidatePages(venue_ids=[venue_id],
+        artist_ids=showPartners(Show.artist_id, Show.venue_id, venue_id))
+      completions.rename('venue', venue_id, old_name, request.form.get("name"))
     flash('Venue ' + request.form['name'] + ' was successfully updated!')
   except Exception as err:
     flash('An error occurred. Venue ' + request.form['name'] + ' could not be updated.')
@@ -534,30 +995,25 @@ def create_artist_submission():
   artist = Artist()
 
   form = ArtistForm()
-  if not form.validate_on_submit():
+  if not validated(form):
     return render_template('forms/new_artist.html', form=form)
 
-  city = db.session.query(City).filter_by(name = request.form.get("city")).first()
-  if not city:
-    city = City(request.form.get("city"))
-  state = db.session.query(State).filter_by(name = request.form.get("state")).first()
-  if not state:
-    state = State(request.form.get("state"))
+  city_id = dimensionId(City, request.form.get("city"))
+  state_id = dimensionId(State, request.form.get("state"))
 
   try:
-    genres = []
-    for genre in request.form.getlist("genres"):
-      genres.append(Genre(name=genre))
+    genres = genresNamed(request.form.getlist("genres"))
 
     artist.name = request.form.get("name")
-    artist.city = city
+    artist.city_id = city_id
     artist.phone = request.form.get("phone")
-    artist.state = state
+    artist.state_id = state_id
     artist.facebook_link = request.form.get("facebook_link")
     artist.genres = genres
 
     db.session.add(artist)
     db.session.commit()
+    completions.add('artist', artist.id, artist.name)
     flash('Artist ' + request.form['name'] + ' was successfully listed!')
   except Exception as err:
     flash('An error occurred. Artist ' + request.form['name'] + ' could not be listed.')
@@ -568,22 +1024,148 @@ def create_artist_submission():
 #  Shows
 #  ----------------------------------------------------------------
 
+def encodeCursor(start_time, show_id):
+  raw = '{}|{}'.format(start_time.isoformat(), show_id)
+  return urlsafe_b64encode(raw.encode()).decode()
+
+def decodeCursor(cursor):
+  try:
+    start_time, show_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return toUTC(start_time), int(show_id)
+  except ValueError:
+    abort(400)
+
+SHOW_LOCATION_FILTERS = ('city', 'state', 'venue_id', 'artist_id')
+SHOW_FILTERS = ('from', 'to', 'preset') + SHOW_LOCATION_FILTERS
+
+def parseDay(value):
+  return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc) if value else None
+
+def showRange():
+  # [start, end) in UTC from ?preset=weekend|next30 or the days ?from= / ?to=
+  today = utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+  preset = request.args.get('preset')
+  if preset == 'weekend':
+    start = today + timedelta(days=max(4 - today.weekday(), 0))
+    return start, start + timedelta(days=7 - start.weekday())
+  if preset == 'next30':
+    return today, today + timedelta(days=30)
+  if preset:
+    abort(400)
+  try:
+    start = parseDay(request.args.get('from'))
+    end = parseDay(request.args.get('to'))
+  except ValueError:
+    abort(400)
+  return start, end and end + timedelta(days=1)
+
+def filterShows(query, start, end):
+  # the start_time range is a slice of ix_show_start_time_id; the location
+  # filters are venue id lists the planner can also probe
+  # ix_show_venue_id_start_time with
+  if start:
+    query = query.where(Show.start_time >= start)
+  if end:
+    query = query.where(Show.start_time < end)
+  venues = select([Venue.id])
+  for name, column, model in (('city', Venue.city_id, City), ('state', Venue.state_id, State)):
+    if request.args.get(name):
+      venues = venues.where(column == select([model.id])
+        .where(model.name == request.args[name]).scalar_subquery())
+  if request.args.get('city') or request.args.get('state'):
+    query = query.where(Show.venue_id.in_(venues))
+  for name, column in (('venue_id', Show.venue_id), ('artist_id', Show.artist_id)):
+    if request.args.get(name):
+      id = request.args.get(name, type=int)
+      if id is None:
+        abort(400)
+      query = query.where(column == id)
+  return query
+
+def showCalendar(start, end):
+  # shows per day, counted in SQL, for a strip of days around the range
+  days = app.config['SHOWS_CALENDAR_DAYS']
+  if start is None:
+    start = end - timedelta(days=days) if end else \
+      utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+  end = min(end or start + timedelta(days=days),
+    start + timedelta(days=app.config['SHOWS_CALENDAR_MAX_DAYS']))
+
+  if db.engine.dialect.name == 'postgresql':
+    day = func.date(func.timezone('UTC', Show.start_time))
+  else:
+    day = func.date(Show.start_time)
+  counts = dict((str(date)[:10], count) for date, count in
+    (yield filterShows(select([day, func.count(Show.id)]), start, end).group_by(day)))
+
+  location = dict((name, request.args[name]) for name in SHOW_LOCATION_FILTERS if request.args.get(name))
+  calendar = []
+  while start < end:
+    date = start.strftime('%Y-%m-%d')
+    calendar.append({
+      "date": start,
+      "count": counts.get(date, 0),
+      "url": url_for('shows', **dict(location, **{'from': date, 'to': date}))
+    })
+    start += timedelta(days=1)
+  return calendar
+
 @app.route('/shows')
+@replica_reads
+@conditional(showsStamp)
 def shows():
+  return renderPage(showsPage())
+
+def showsPage():
+  per_page = request.args.get('per_page', app.config['SHOWS_PER_PAGE'], type=int)
+  per_page = max(1, min(per_page, app.config['SHOWS_MAX_PER_PAGE']))
+  after = request.args.get('after')
+  before = request.args.get('before')
+  start, end = showRange()
+
+  query = select([Show.id, Show.start_time, Show.venue_id, Venue.name,
+      Show.artist_id, Artist.name, Artist.image_link]) \
+    .join_from(Show, Venue, Show.venue_id == Venue.id) \
+    .join(Artist, Show.artist_id == Artist.id)
+  query = filterShows(query, start, end)
+  key = tuple_(Show.start_time, Show.id)
+  if before:
+    query = query.where(key < decodeCursor(before)) \
+      .order_by(Show.start_time.desc(), Show.id.desc())
+  else:
+    if after:
+      query = query.where(key > decodeCursor(after))
+    query = query.order_by(Show.start_time, Show.id)
+
+  # one extra row tells us whether there is another page in that direction
+  rows = (yield query.limit(per_page + 1)).fetchall()
+  has_more = len(rows) > per_page
+  rows = rows[:per_page]
+  if before:
+    rows.reverse()
+
   data = []
-  show_objs = db.session.query(Show).all()
-  
-  for obj in show_objs:
-    show = {}
-    show["venue_id"] = obj.venue_id
-    show["venue_name"] = obj.venue.name
-    show["artist_id"] = obj.artist_id
-    show["artist_name"] = obj.artist.name
-    show["artist_image_link"] = obj.artist.image_link
-    show["start_time"] = obj.start_time
-    data.append(show)
-
-  return render_template('pages/shows.html', shows=data)
+  for id, start_time, venue_id, venue_name, artist_id, artist_name, artist_image_link in rows:
+    data.append({
+      "venue_id": venue_id,
+      "venue_name": venue_name,
+      "artist_id": artist_id,
+      "artist_name": artist_name,
+      "artist_image_link": artist_image_link,
+      "start_time": start_time
+    })
+
+  prev_cursor = next_cursor = None
+  if rows:
+    if (has_more if before else after):
+      prev_cursor = encodeCursor(rows[0].start_time, rows[0].id)
+    if (before or has_more):
+      next_cursor = encodeCursor(rows[-1].start_time, rows[-1].id)
+
+  filters = dict((name, request.args[name]) for name in SHOW_FILTERS if request.args.get(name))
+  calendar = yield from showCalendar(start, end)
+  return 'pages/shows.html', dict(shows=data, per_page=per_page,
+    prev_cursor=prev_cursor, next_cursor=next_cursor, filters=filters, calendar=calendar)
 
 @app.route('/shows/create')
 def create_shows():
@@ -595,24 +1177,248 @@ def create_shows():
 def create_show_submission():
 
   form = ShowForm()
-  if not form.validate_on_submit():
+  if not validated(form):
+    return render_template('forms/new_show.html', form=form)
+
+  start_time = toUTC(form.start_time.data)
+  end_time = start_time + timedelta(minutes=form.duration.data or app.config['SHOW_DURATION_MINUTES'])
+  venue = db.session.query(Venue).filter_by(id = form.venue_id.data).first()
+  artist = db.session.query(Artist).filter_by(id = form.artist_id.data).first()
+  for field, column, name, found in ((form.venue_id, Show.venue_id, 'venue', venue),
+                                     (form.artist_id, Show.artist_id, 'artist', artist)):
+    if found is None:
+      field.errors.append('There is no {} with id {}.'.format(name, field.data))
+      continue
+    clash = bookingConflict(column, field.data, start_time, end_time)
+    if clash:
+      field.errors.append('The {} is already booked from {} to {}.'.format(name,
+        format_datetime(clash.start_time, 'full'), format_datetime(clash.end_time, 'full')))
+  if form.venue_id.errors or form.artist_id.errors:
     return render_template('forms/new_show.html', form=form)
 
   try:
-    venue = db.session.query(Venue).filter_by(id = request.form.get("venue_id")).first()
-    show = Show(start_time=request.form.get("start_time"))
-    show.artist = db.session.query(Artist).filter_by(id = request.form.get("artist_id")).first()
+    show = Show(start_time=start_time, end_time=end_time)
+    show.artist = artist
     show.venue = venue
 
     db.session.add(show)
     db.session.commit()
+    invalidatePages(venue_ids=[show.venue_id], artist_ids=[show.artist_id])
     flash('Show was successfully listed!')
+  except IntegrityError as err:
+    db.session.rollback()
+    if isDoubleBooking(err):
+      # booked by someone else between the check and the insert
+      form.start_time.errors.append('The venue or the artist is already booked at that time.')
+      return render_template('forms/new_show.html', form=form)
+    flash('An error occurred. Show could not be listed.')
+    print(err)
   except Exception as err:
     flash('An error occurred. Show could not be listed.')
     print(err)
 
   return render_template('pages/home.html')
 
+#  Export
+#  ----------------------------------------------------------------
+
+def exportRange(query, column):
+  # ?since= / ?until= bound start_time for shows and updated_at for venues/artists
+  since = request.args.get('since')
+  until = request.args.get('until')
+  try:
+    if since:
+      query = query.filter(column >= toUTC(since))
+    if until:
+      query = query.filter(column < toUTC(until))
+  except (ValueError, OverflowError):
+    abort(400)
+  return query
+
+def exportQuery(entity):
+  if entity == 'shows':
+    query = db.session.query(Show.id, Show.start_time, Show.end_time, Show.venue_id,
+        Venue.name.label('venue_name'), Show.artist_id, Artist.name.label('artist_name')) \
+      .join(Venue, Show.venue_id == Venue.id) \
+      .join(Artist, Show.artist_id == Artist.id)
+    return exportRange(query, Show.start_time).order_by(Show.start_time, Show.id)
+
+  model = Venue if entity == 'venues' else Artist
+  columns = [model.id, model.name, City.name.label('city'), State.name.label('state')]
+  if model is Venue:
+    columns.append(Address.name.label('address'))
+  columns += [model.phone, model.website, model.facebook_link, model.image_link,
+    model.seeking_talent if model is Venue else model.seeking_venue,
+    model.seeking_description, model.upcoming_shows_count, model.past_shows_count]
+  columns.append(model.updated_at)
+  query = db.session.query(*columns).select_from(model).join(City).join(State)
+  if model is Venue:
+    query = query.join(Address)
+  return exportRange(query, model.updated_at).order_by(model.id)
+
+def exportValue(value):
+  return value.isoformat() if isinstance(value, datetime) else value
+
+@app.route('/export/<any(shows, venues, artists):entity>.<any(csv, ndjson):format>')
+@replica_reads
+def export(entity, format):
+  # rows are streamed from a server-side cursor, batch_size at a time
+  batch_size = app.config['EXPORT_BATCH_SIZE']
+  query = exportQuery(entity)
+  columns = [column['name'] for column in query.column_descriptions]
+
+  def generate():
+    rows = iter(query.yield_per(batch_size))
+    if format == 'csv':
+      buffer = io.StringIO()
+      writer = csv.writer(buffer)
+      writer.writerow(columns)
+      for batch in iter(lambda: list(islice(rows, batch_size)), []):
+        writer.writerows([exportValue(value) for value in row] for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+      yield buffer.getvalue()
+    else:
+      for batch in iter(lambda: list(islice(rows, batch_size)), []):
+        yield ''.join(json.dumps(dict(zip(columns, row)), default=exportValue) + '\n'
+          for row in batch)
+
+  filename = '{}-{}.{}'.format(entity, utcnow().strftime('%Y%m%dT%H%M%SZ'), format)
+  mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+  return Response(stream_with_context(generate()), mimetype=mimetype,
+    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
+
+#  API
+#  ----------------------------------------------------------------
+
+def apiResponse(payload, status=200):
+  body = dumps(payload)
+  response = Response(body, status=status, mimetype='application/json')
+  response.vary.add('Accept-Encoding')
+  if len(body) >= app.config['API_GZIP_MIN_SIZE'] and request.accept_encodings['gzip']:
+    response.set_data(gzip.compress(body, app.config['API_GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+  return response
+
+def apiError(status, message):
+  return apiResponse({"error": message}, status)
+
+def apiListing(entity):
+  limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+  limit = max(1, min(limit, app.config['API_MAX_PAGE_SIZE']))
+  after = request.args.get('after')
+  before = request.args.get('before')
+  try:
+    fields = statements.parse_fields(entity, request.args.get('fields'))
+    after = decode_cursor(entity, after) if after else None
+    before = decode_cursor(entity, before) if before else None
+  except ValueError as err:
+    return apiError(400, str(err))
+
+  width = len(statements.keys[entity])
+  rows = db.session.execute(statements.listing(entity, fields, after, before, limit)).fetchall()
+  rows, prev_cursor, next_cursor = paginate(rows, limit, after, before, width)
+  data = records(fields, rows, width)
+  if 'genres' in fields:
+    ids = [row[0] for row in rows]
+    add_genres(data, ids, db.session.execute(statements.genres(entity, ids)))
+  return apiResponse({"data": data, "prev_cursor": prev_cursor, "next_cursor": next_cursor})
+
+def apiDetail(entity, id):
+  try:
+    fields = statements.parse_fields(entity, request.args.get('fields'), detail=True)
+  except ValueError as err:
+    return apiError(400, str(err))
+
+  row = db.session.execute(statements.detail(entity, id, fields)).first()
+  if row is None:
+    return apiError(404, 'not found')
+  data = records(fields, [row], 1)[0]
+  if 'genres' in fields:
+    add_genres([data], [id], db.session.execute(statements.genres(entity, [id])))
+  now = utcnow()
+  for field, upcoming in (('past_shows', False), ('upcoming_shows', True)):
+    if field in fields:
+      data[field] = [dict(show._mapping) for show in
+        db.session.execute(statements.partner_shows(entity, id, upcoming, now))]
+  return apiResponse(data)
+
+def apiSearch(entity):
+  try:
+    fields = statements.parse_fields(entity, request.args.get('fields'))
+  except ValueError as err:
+    return apiError(400, str(err))
+
+  rows = db.session.execute(statements.search(entity, request.args.get('q', ''), fields,
+    app.config['SEARCH_RESULTS_LIMIT'], db.engine.dialect.name)).fetchall()
+  data = records(fields, rows, 2)
+  if 'genres' in fields:
+    ids = [row[0] for row in rows]
+    add_genres(data, ids, db.session.execute(statements.genres(entity, ids)))
+  return apiResponse({"count": rows[0][1] if rows else 0, "data": data})
+
+@app.route('/api/v1/venues')
+@replica_reads
+@conditional(listStamp(Venue))
+def api_venues():
+  return apiListing('venues')
+
+@app.route('/api/v1/venues/search')
+@replica_reads
+def api_search_venues():
+  return apiSearch('venues')
+
+@app.route('/api/v1/venues/<int:venue_id>')
+@replica_reads
+@conditional(venueStamp)
+def api_venue(venue_id):
+  return apiDetail('venues', venue_id)
+
+@app.route('/api/v1/artists')
+@replica_reads
+@conditional(listStamp(Artist))
+def api_artists():
+  return apiListing('artists')
+
+@app.route('/api/v1/artists/search')
+@replica_reads
+def api_search_artists():
+  return apiSearch('artists')
+
+@app.route('/api/v1/artists/<int:artist_id>')
+@replica_reads
+@conditional(artistStamp)
+def api_artist(artist_id):
+  return apiDetail('artists', artist_id)
+
+@app.route('/api/v1/shows')
+@replica_reads
+@conditional(showsStamp)
+def api_shows():
+  return apiListing('shows')
+
+@app.route('/api/v1/shows/conflicts')
+@replica_reads
+def api_show_conflicts():
+  limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+  limit = max(1, min(limit, app.config['API_MAX_PAGE_SIZE']))
+  data = {}
+  for entity, column in (('venues', Show.venue_id), ('artists', Show.artist_id)):
+    owner = entity[:-1] + '_id'
+    data[entity] = [{
+      owner: owner_id,
+      "show": {"id": show_id, "start_time": start_time, "end_time": end_time},
+      "conflicts_with": {"id": other_id, "start_time": other_start, "end_time": other_end}
+    } for owner_id, show_id, start_time, end_time, other_id, other_start, other_end
+      in bookingConflicts(column, limit)]
+  return apiResponse(data)
+
+@app.route('/cache/stats')
+def cache_stats():
+  return jsonify(pages=response_cache.stats(), lookups=lookups.stats(),
+    autocomplete=completions.stats())
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -632,6 +1438,133 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     app.logger.info('errors')
 
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+@app.cli.command('rollover-shows')
+def rollover_shows_command():
+  """Move shows that have started from the upcoming to the past counters."""
+  moved = rolloverShows(utcnow())
+  click.echo('{} show(s) rolled over'.format(moved))
+
+@app.cli.command('reconcile-show-counts')
+def reconcile_show_counts_command():
+  """Recompute the venue/artist show counters from the show table."""
+  drifted = reconcileShowCounts(utcnow())
+  click.echo('{} venue/artist row(s) repaired'.format(drifted))
+
+@app.cli.command('profile-token')
+def profile_token_command():
+  """Print a token that turns on profiling for the requests carrying it."""
+  if not app.config.get('PROFILE_SECRET'):
+    raise click.ClickException('Set PROFILE_SECRET first.')
+  click.echo(profiler.token())
+
+def countImportedShows(connection, entity, rows):
+  if entity == 'shows':
+    deltas = Counter()
+    for row in rows:
+      column = 'upcoming_shows_count' if row['counted_as_upcoming'] else 'past_shows_count'
+      deltas[(Venue, row['venue_id'], column)] += 1
+      deltas[(Artist, row['artist_id'], column)] += 1
+    applyShowCounts(connection, deltas)
+
+@app.cli.command('import-data')
+@click.argument('entity', type=click.Choice(sorted(ENTITIES)))
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']),
+  help='Defaults to the file extension.')
+@click.option('--chunk-size', default=5000, show_default=True)
+@click.option('--rejects', type=click.File('a', encoding='utf-8'),
+  help='Where rejected records go. Defaults to SOURCE.rejects.ndjson.')
+def import_data_command(entity, source, format, chunk_size, rejects):
+  """Stream ENTITY records from a CSV or NDJSON file ('-' for stdin)."""
+  format = format or ('csv' if source.name.endswith('.csv') else 'ndjson')
+  # click names stdin '<stdin>'
+  rejects = rejects or click.open_file(source.name + '.rejects.ndjson'
+    if source.name != '<stdin>' else 'rejects.ndjson', 'a', encoding='utf-8')
+  venue_ids, artist_ids = set(), set()
+
+  def onChunk(connection, entity, rows):
+    countImportedShows(connection, entity, rows)
+    if entity == 'shows':
+      venue_ids.update(row['venue_id'] for row in rows)
+      artist_ids.update(row['artist_id'] for row in rows)
+
+  def progress(stats):
+    click.echo('{}: {} imported, {} rejected, {:.0f} rows/s'.format(
+      entity, stats.imported, stats.rejected, stats.rate), err=True)
+
+  with db.engine.connect() as connection, rejects:
+    stats = Importer(connection, db.metadata, entity, chunk_size=chunk_size,
+      rejects=rejects, on_chunk=onChunk, progress=progress,
+      show_duration=timedelta(minutes=app.config['SHOW_DURATION_MINUTES']),
+      max_show_duration=timedelta(minutes=app.config['SHOW_MAX_DURATION_MINUTES'])) \
+      .run(read_records(source, format))
+  # as after a show is created through the form; the running workers pick up
+  # new names for /autocomplete at their next reload (AUTOCOMPLETE_MAX_AGE)
+  invalidatePages(venue_ids=venue_ids, artist_ids=artist_ids)
+  click.echo('{}: {} imported, {} rejected in {:.1f}s'.format(
+    entity, stats.imported, stats.rejected, stats.elapsed))
+
+#----------------------------------------------------------------------------#
+# Startup.
+#----------------------------------------------------------------------------#
+
+def warmCaches():
+  """Fill this worker's lookup caches from the database."""
+  with app.app_context():
+    for model in LOOKUP_MODELS:
+      warmLookups(model)
+
+def warmCachesInBackground():
+  # the autocomplete indexes are only (re)loaded here, never by a request;
+  # in between, the handlers keep them up to date with this worker's changes
+  def run():
+    try:
+      warmCaches()
+    except Exception as err:
+      # e.g. before the first migration; the caches then warm on first use
+      app.logger.info('Lookup caches not warmed at startup: %s', err)
+    while True:
+      try:
+        loadCompletions()
+      except Exception as err:
+        app.logger.warning('Autocomplete indexes not loaded: %s', err)
+      time.sleep(app.config['AUTOCOMPLETE_MAX_AGE'])
+  Thread(target=run, name='warm-caches', daemon=True).start()
+
+# Each worker process starts its warm-up thread when it begins serving: on
+# its first request, or from the ASGI lifespan startup. Importing the app --
+# a flask CLI command, asgi.py, the benchmarks, a pre-forking master --
+# starts nothing, and a forked worker starts its own (threads do not
+# survive a fork).
+warm_up = {'pid': None, 'lock': Lock()}
+
+def warmCachesOnce():
+  if not app.config['WARM_CACHES'] or warm_up['pid'] == os.getpid():
+    return
+  with warm_up['lock']:
+    if warm_up['pid'] != os.getpid():
+      warm_up['pid'] = os.getpid()
+      warmCachesInBackground()
+
+app.before_request(warmCachesOnce)
+
+def resetAfterFork():
+  # a forked worker must not share its parent's database connections, nor
+  # inherit a lock some other thread of the parent held at the fork
+  with app.app_context():
+    db.engine.dispose(close=False)
+  for replica in app.extensions['replicas'].replicas:
+    replica.engine.dispose(close=False)
+  lookups.after_fork()
+  completions.after_fork()
+  warm_up['lock'] = Lock()
+
+os.register_at_fork(after_in_child=resetAfterFork)
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
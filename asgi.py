@@ -0,0 +1,479 @@
+#----------------------------------------------------------------------------#
+# ASGI entry point:  uvicorn asgi:application
+#
+# The reads are answered on the event loop with an async engine (asyncpg on
+# Postgres, aiosqlite on SQLite), so a slow client or a slow query holds no
+# thread: GETs of the JSON API (/api/v1) run the statements in api.py, and
+# the HTML listing, detail and search pages run app.py's page builders (see
+# runReads), rendering their templates on a worker thread. They get what the
+# Flask hooks give the same routes: conditional GETs, the page cache, the
+# request metrics, Server-Timing and the SQL warnings, and traces; only the
+# profiler does not see them. Everything else -- forms, writes, exports, and
+# pages carrying flashed messages -- goes to the Flask app through asgiref's
+# WSGI adapter, each request on a thread of its own.
+#----------------------------------------------------------------------------#
+
+import asyncio
+import gzip
+import re
+import time
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qsl
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from flask import g, render_template
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+from werkzeug.test import EnvironBuilder
+
+from api import Statements, add_genres, decode_cursor, dumps, paginate, records
+from app import (Artist, Venue, app, artistPage, artistStamp, artistsPage, db, isFresh, listStamp,
+                 metrics, newest, response_cache, searchPage, showsPage, showsStamp,
+                 sql_instrumentation, stampResponse, stampValidators, toUTC, tracer, utcnow,
+                 venuePage, venueStamp, venuesPage, warmCachesOnce)
+from cache import LRUBackend
+from instrumentation import RequestStats
+from routing import STICKY_COOKIE
+
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_uri(uri):
+    scheme, rest = uri.split('://', 1)
+    return '{}://{}'.format(ASYNC_DRIVERS.get(scheme.split('+')[0], scheme), rest)
+
+
+#----------------------------------------------------------------------------#
+# Handlers: (reads, connection, args, *url groups) -> (status, payload)
+#----------------------------------------------------------------------------#
+
+async def listing(reads, connection, args, entity):
+    config = app.config
+    try:
+        limit = int(args.get('limit', config['API_PAGE_SIZE']))
+    except ValueError:
+        limit = config['API_PAGE_SIZE']
+    limit = max(1, min(limit, config['API_MAX_PAGE_SIZE']))
+    try:
+        fields = reads.statements.parse_fields(entity, args.get('fields'))
+        after = decode_cursor(entity, args['after']) if args.get('after') else None
+        before = decode_cursor(entity, args['before']) if args.get('before') else None
+    except ValueError as err:
+        return 400, {'error': str(err)}
+
+    width = len(reads.statements.keys[entity])
+    result = await connection.execute(
+        reads.statements.listing(entity, fields, after, before, limit))
+    rows, prev_cursor, next_cursor = paginate(result.fetchall(), limit, after, before, width)
+    data = records(fields, rows, width)
+    if 'genres' in fields:
+        ids = [row[0] for row in rows]
+        add_genres(data, ids, await connection.execute(reads.statements.genres(entity, ids)))
+    return 200, {'data': data, 'prev_cursor': prev_cursor, 'next_cursor': next_cursor}
+
+
+async def detail(reads, connection, args, entity, id):
+    id = int(id)
+    try:
+        fields = reads.statements.parse_fields(entity, args.get('fields'), detail=True)
+    except ValueError as err:
+        return 400, {'error': str(err)}
+
+    row = (await connection.execute(reads.statements.detail(entity, id, fields))).first()
+    if row is None:
+        return 404, {'error': 'not found'}
+    data = records(fields, [row], 1)[0]
+    if 'genres' in fields:
+        add_genres([data], [id], await connection.execute(reads.statements.genres(entity, [id])))
+    now = utcnow()
+    for field, upcoming in (('past_shows', False), ('upcoming_shows', True)):
+        if field in fields:
+            result = await connection.execute(
+                reads.statements.partner_shows(entity, id, upcoming, now))
+            data[field] = [dict(show._mapping) for show in result]
+    return 200, data
+
+
+async def search(reads, connection, args, entity):
+    try:
+        fields = reads.statements.parse_fields(entity, args.get('fields'))
+    except ValueError as err:
+        return 400, {'error': str(err)}
+
+    result = await connection.execute(reads.statements.search(
+        entity, args.get('q', ''), fields, app.config['SEARCH_RESULTS_LIMIT'], reads.dialect))
+    rows = result.fetchall()
+    data = records(fields, rows, 2)
+    if 'genres' in fields:
+        ids = [row[0] for row in rows]
+        add_genres(data, ids, await connection.execute(reads.statements.genres(entity, ids)))
+    return 200, {'count': rows[0][1] if rows else 0, 'data': data}
+
+
+#----------------------------------------------------------------------------#
+# Validators: the (last_modified, key) stamps of app.py's API routes.
+#----------------------------------------------------------------------------#
+
+async def listing_stamp(reads, connection, scope, entity):
+    if entity == 'shows':
+        # as showsStamp
+        tables = ['show', 'venue', 'artist']
+        key = 'shows:{}:{}'.format(utcnow().date(), scope['query_string'].decode())
+    else:
+        tables = [entity[:-1]]
+        key = entity[:-1]
+    row = (await connection.execute(reads.statements.changed(tables))).one()
+    return newest(row), key
+
+
+async def detail_stamp(reads, connection, scope, entity, id):
+    row = (await connection.execute(reads.statements.changed_partners(entity, int(id)))).first()
+    return row and (newest(row), '{}:{}'.format(entity[:-1], id))
+
+
+def fresh(headers, etag, last_modified):
+    etags = parse_etags(headers.get(b'if-none-match', b'').decode('latin-1'))
+    if etags:
+        return etags.contains_weak(etag)
+    since = parse_date(headers.get(b'if-modified-since', b'').decode('latin-1'))
+    return since is not None and last_modified <= toUTC(since)
+
+
+ROUTES = [
+    (re.compile(r'^/api/v1/(venues|artists|shows)$'), listing, listing_stamp),
+    (re.compile(r'^/api/v1/(venues|artists)/search$'), search, None),
+    (re.compile(r'^/api/v1/(venues|artists)/(\d+)$'), detail, detail_stamp),
+]
+
+
+#----------------------------------------------------------------------------#
+# HTML pages: Flask endpoint -> (page builder, stamp builder, page cache key),
+# each called with the view arguments of the matched rule.
+#----------------------------------------------------------------------------#
+
+def search_venues():
+    return searchPage(Venue)
+
+
+def search_artists():
+    return searchPage(Artist)
+
+
+PAGES = {
+    'venues': (venuesPage, listStamp(Venue), None),
+    'artists': (artistsPage, listStamp(Artist), None),
+    'shows': (showsPage, showsStamp, None),
+    'show_venue': (venuePage, venueStamp, 'venue:{venue_id}'),
+    'show_artist': (artistPage, artistStamp, 'artist:{artist_id}'),
+    'search_venues': (search_venues, None, None),
+    'search_artists': (search_artists, None, None),
+}
+
+
+async def drive(reads, connection):
+    """Run a page or stamp builder of app.py on an async connection."""
+    try:
+        statement = next(reads)
+        while True:
+            statement = reads.send(await connection.execute(statement))
+    except StopIteration as done:
+        return done.value
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    return EnvironBuilder(
+        path=scope['path'], method=scope['method'],
+        base_url='{}://{}:{}{}'.format(scope.get('scheme', 'http'), server[0], server[1],
+                                       scope.get('root_path', '')),
+        query_string=scope['query_string'].decode('latin-1'),
+        headers=Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                         for name, value in scope['headers']]),
+        data=body, environ_overrides={'REMOTE_ADDR': client[0]}).get_environ()
+
+
+def has_flashes(environ):
+    session = app.session_interface.open_session(app, app.request_class(environ))
+    return session is not None and '_flashes' in session
+
+
+async def read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(body)
+
+
+def replay(body):
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return receive
+
+
+#----------------------------------------------------------------------------#
+# Application.
+#----------------------------------------------------------------------------#
+
+class ThreadedWsgi(WsgiToAsgi):
+    # asgiref runs WSGI apps thread_sensitive, i.e. every request on one shared
+    # thread; Flask does not need that, so each request gets a thread of its
+    # own (a ThreadSensitiveContext), at most ASGI_WSGI_THREADS at a time.
+
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.threads = threads
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        if self._slots is None:
+            # made on the event loop that serves the requests
+            self._slots = asyncio.Semaphore(self.threads)
+        async with self._slots:
+            async with ThreadSensitiveContext():
+                await super().__call__(scope, receive, send)
+
+
+class AsyncReads(object):
+
+    def __init__(self, app, db):
+        config = app.config
+        uri = config.get('ASYNC_DATABASE_URI') or async_uri(config['SQLALCHEMY_DATABASE_URI'])
+        self.primary = self.create_engine(uri, config)
+        self.replicas = [self.create_engine(async_uri(uri), config)
+                         for uri in config.get('SQLALCHEMY_REPLICA_URIS', [])]
+        self.dialect = self.primary.dialect.name
+        self.statements = Statements(db.metadata)
+        self.wsgi = ThreadedWsgi(app, config['ASGI_WSGI_THREADS'])
+        # the Flask endpoints and rules, for the metrics and traces
+        self.urls = app.url_map.bind('')
+        self._next = 0
+
+    @staticmethod
+    def create_engine(uri, config):
+        options = {}
+        if not uri.startswith('sqlite'):
+            options = {'pool_size': config['ASYNC_POOL_SIZE'],
+                       'max_overflow': config['ASYNC_MAX_OVERFLOW']}
+        return create_async_engine(uri, **options)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for pattern, handler, validator in ROUTES:
+                match = pattern.match(scope['path'])
+                if match:
+                    return await self.respond(scope, send, self.read_api(
+                        scope, handler, validator, match.groups()))
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD', 'POST'):
+            try:
+                endpoint, view_args = self.urls.match(scope['path'], scope['method'])
+            except HTTPException:
+                endpoint = None
+            if endpoint in PAGES:
+                body = await read_body(receive) if scope['method'] == 'POST' else b''
+                environ = build_environ(scope, body)
+                # flashed messages are shown once, by the session-aware Flask side
+                if not has_flashes(environ):
+                    return await self.respond(scope, send, self.read_page(
+                        environ, endpoint, view_args))
+                receive = replay(body)
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # the API reads never run the Flask hook that starts it
+                warmCachesOnce()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in [self.primary] + self.replicas:
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self, headers, primary=False):
+        # same routing as @replica_reads: replicas unless the client wrote recently
+        if self.replicas and not primary and self.primary_until(headers) < time.time():
+            engine = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            try:
+                return await engine.connect()
+            except (OSError, DBAPIError):
+                pass
+        return await self.primary.connect()
+
+    @staticmethod
+    def primary_until(headers):
+        try:
+            cookie = SimpleCookie(headers.get(b'cookie', b'').decode('latin-1'))
+            return float(cookie[STICKY_COOKIE].value) if STICKY_COOKIE in cookie else 0
+        except (CookieError, ValueError):
+            return 0
+
+    async def respond(self, scope, send, read):
+        """Answer with read(headers, trace, stats) -> (status, body, headers)."""
+        started = time.perf_counter()
+        headers = dict(scope['headers'])
+        method = scope['method']
+        rule = self.urls.match(scope['path'], method, return_rule=True)[0]
+        trace = None
+        if tracer.enabled:
+            target = scope['path'] + ('?' + scope['query_string'].decode('latin-1')
+                                      if scope['query_string'] else '')
+            trace = tracer.start_trace(
+                headers.get(b'traceparent', b'').decode('latin-1'), method, rule.rule, target,
+                headers.get(b'user-agent', b'').decode('latin-1'))
+        stats = RequestStats() if sql_instrumentation.enabled else None
+
+        view = trace.start('view ' + rule.endpoint) if trace is not None else None
+        try:
+            status, body, response_headers = await read(headers, trace, stats)
+        except Exception as error:
+            metrics.record(method, rule.endpoint, 500, started)
+            if trace is not None:
+                tracer.set_status(trace, 500)
+                tracer.export_trace(trace, error)
+            raise
+        if view is not None:
+            trace.finish(view)
+
+        response_headers.append((b'content-length', str(len(body)).encode()))
+        if stats is not None:
+            for timing in sql_instrumentation.report(stats, method, scope['path'], rule.endpoint):
+                response_headers.append((b'server-timing', timing.encode()))
+        if trace is not None:
+            response_headers.append((b'traceparent', tracer.set_status(trace, status).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+        await send({'type': 'http.response.body',
+                    'body': body if method != 'HEAD' else b''})
+        metrics.record(method, rule.endpoint, status, started)
+        metrics.sync_caches()
+        if trace is not None:
+            tracer.export_trace(trace)
+
+    def read_api(self, scope, handler, validator, groups):
+        """(status, JSON body, headers) of an API read; a 304 has no body."""
+        async def read(headers, trace, stats):
+            args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+            status, payload, response_headers = await self.read(
+                scope, headers, args, handler, validator, groups, trace, stats)
+            if payload is None:
+                return status, b'', response_headers
+            body = dumps(payload)
+            response_headers += [(b'content-type', b'application/json'),
+                                 (b'vary', b'Accept-Encoding')]
+            if len(body) >= app.config['API_GZIP_MIN_SIZE'] and \
+                    b'gzip' in headers.get(b'accept-encoding', b''):
+                body = gzip.compress(body, app.config['API_GZIP_LEVEL'])
+                response_headers.append((b'content-encoding', b'gzip'))
+            return status, body, response_headers
+        return read
+
+    async def read(self, scope, headers, args, handler, validator, groups, trace, stats):
+        """(status, payload or None for a 304, headers) of an API read."""
+        # the connection goes back to the pool before the body is sent
+        connection = await self.connect(headers)
+        # the engine events find the request's stats and trace on the connection
+        info = connection.sync_connection.info
+        if stats is not None:
+            info['sql_stats'] = stats
+        if trace is not None:
+            info['trace'] = trace
+        try:
+            stamp = validator and await validator(self, connection, scope, *groups)
+            if not stamp:
+                status, payload = await handler(self, connection, args, *groups)
+                return status, payload, []
+            etag, last_modified = stampValidators(stamp)
+            validators = [(b'etag', quote_etag(etag, weak=True).encode()),
+                          (b'last-modified', http_date(last_modified).encode()),
+                          (b'cache-control', b'public, no-cache')]
+            if fresh(headers, etag, last_modified):
+                return 304, None, validators
+            status, payload = await handler(self, connection, args, *groups)
+            return status, payload, validators
+        finally:
+            info.pop('sql_stats', None)
+            info.pop('trace', None)
+            await connection.close()
+
+    def read_page(self, environ, endpoint, view_args):
+        """(status, HTML body, headers) of one of the PAGES, as its Flask view
+        would answer: same validators, page cache and error pages."""
+        async def read(headers, trace, stats):
+            with app.request_context(environ):
+                # where the engine events and template signals look for them
+                g.sql_stats = stats
+                g.trace = trace
+                try:
+                    response = await self.page(headers, endpoint, view_args)
+                except HTTPException as error:
+                    response = app.make_response(app.handle_http_exception(error))
+                finally:
+                    # the trace is exported by respond, not by the tracer's teardown
+                    g.pop('trace', None)
+                body = response.get_data()
+                response.headers.pop('Content-Length', None)
+                return response.status_code, body, [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in response.headers.items()]
+        return read
+
+    async def page(self, headers, endpoint, view_args):
+        builder, validator, cache_key = PAGES[endpoint]
+        stamp = html = None
+        cache_status = 'HIT'
+        connection = await self.connect(headers)
+        try:
+            stamp = validator and await drive(validator(**view_args), connection)
+            if stamp:
+                etag, last_modified = stampValidators(stamp)
+                if isFresh(etag, last_modified):
+                    return stampResponse(app.response_class(status=304), etag, last_modified)
+            if cache_key:
+                cache_key = cache_key.format(**view_args)
+                html = await self.cache(response_cache.get, cache_key)
+                if html is None and connection.engine is not self.primary:
+                    # as cachedPage: what gets stored is read from the primary
+                    await connection.close()
+                    connection = await self.connect(headers, primary=True)
+            if html is None:
+                template, context = await drive(builder(**view_args), connection)
+                cache_status = 'MISS'
+        finally:
+            await connection.close()
+
+        if html is None:
+            # rendering is CPU work: it runs on a thread, in this request's context
+            html = await asyncio.to_thread(render_template, template, **context)
+            if cache_key:
+                await self.cache(response_cache.set, cache_key, html)
+        response = app.response_class(html, mimetype='text/html')
+        if cache_key:
+            response.headers['X-Cache'] = cache_status
+        if stamp:
+            stampResponse(response, etag, last_modified)
+        return response
+
+    @staticmethod
+    async def cache(method, *args):
+        # a shared (Redis) page cache is network I/O: keep it off the event loop
+        if isinstance(response_cache.backend, LRUBackend):
+            return method(*args)
+        return await asyncio.to_thread(method, *args)
+
+
+application = AsyncReads(app, db)
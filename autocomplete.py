@@ -0,0 +1,132 @@
+#----------------------------------------------------------------------------#
+# In-memory prefix index for /autocomplete.
+#
+# Each kind of name (venue, artist, city) is kept as sorted parallel arrays
+# of case-folded keys, display names and ids. A prefix lookup is a bisect to
+# the first key >= prefix followed by at most `limit` steps; inserts and
+# removals are a bisect plus a memmove of the pointer arrays.
+#----------------------------------------------------------------------------#
+
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+
+def fold(name):
+    folded = name.casefold()
+    # share the string when folding changed nothing
+    return name if folded == name else folded
+
+
+class PrefixIndex(object):
+
+    def __init__(self, rows=()):
+        entries = sorted((fold(name), id, name) for id, name in rows if name)
+        self._keys = [key for key, _, _ in entries]
+        self._ids = array('q', [id for _, id, _ in entries])
+        self._names = [name for _, _, name in entries]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def complete(self, prefix, limit=10):
+        prefix = fold(prefix)
+        keys = self._keys
+        matches = []
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and len(matches) < limit and keys[i].startswith(prefix):
+            matches.append((self._ids[i], self._names[i]))
+            i += 1
+        return matches
+
+    def add(self, id, name):
+        key = fold(name)
+        i = bisect_left(self._keys, key)
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._ids[i] == id and self._names[i] == name:
+                return
+            i += 1
+        self._keys.insert(i, key)
+        self._ids.insert(i, id)
+        self._names.insert(i, name)
+
+    def remove(self, id, name):
+        key = fold(name)
+        i = bisect_left(self._keys, key)
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._ids[i] == id:
+                del self._keys[i], self._ids[i], self._names[i]
+                return True
+            i += 1
+        return False
+
+
+class Autocomplete(object):
+    """One PrefixIndex per kind. The app loads them off the request path and
+    reloads them now and then, so changes made by other workers or by
+    import-data show up eventually; changes made through this worker show up
+    at once, including while a load is reading the table.
+    """
+
+    def __init__(self):
+        self._indexes = {}
+        # kind -> [(change, id, name)] made while that kind is loading
+        self._pending = {}
+        self._lock = Lock()
+        self._loading = Lock()
+
+    def load(self, kind, rows):
+        """Build the index of `kind` from (id, name) rows and swap it in.
+
+        The changes made while the rows are read are replayed onto the new
+        index, as the read may or may not have seen them; adding an entry
+        that is there already does nothing."""
+        with self._loading:
+            with self._lock:
+                self._pending[kind] = []
+            try:
+                index = PrefixIndex(rows)
+            except Exception:
+                with self._lock:
+                    del self._pending[kind]
+                raise
+            with self._lock:
+                for change, id, name in self._pending.pop(kind):
+                    getattr(index, change)(id, name)
+                self._indexes[kind] = index
+
+    def complete(self, kind, prefix, limit=10):
+        with self._lock:
+            index = self._indexes.get(kind)
+            return index.complete(prefix, limit) if index is not None else []
+
+    def add(self, kind, id, name):
+        self._change(kind, 'add', id, name)
+
+    def remove(self, kind, id, name):
+        self._change(kind, 'remove', id, name)
+
+    def _change(self, kind, change, id, name):
+        if not name:
+            return
+        with self._lock:
+            index = self._indexes.get(kind)
+            if index is not None:
+                getattr(index, change)(id, name)
+            if kind in self._pending:
+                self._pending[kind].append((change, id, name))
+
+    def rename(self, kind, id, old_name, new_name):
+        if old_name != new_name:
+            self.remove(kind, id, old_name)
+            self.add(kind, id, new_name)
+
+    def stats(self):
+        with self._lock:
+            return dict((kind, len(index)) for kind, index in self._indexes.items())
+
+    def after_fork(self):
+        # in a forked worker: a load the parent was running has no thread here
+        self._pending = {}
+        self._lock = Lock()
+        self._loading = Lock()
@@ -0,0 +1,69 @@
+"""Memory and latency of the /autocomplete prefix index.
+
+    python benchmarks/autocomplete_index.py [names]
+
+Builds an autocomplete.PrefixIndex over synthetic venue-like names (1M by
+default) and reports the memory it holds (keys, display names and ids), per-lookup latency for prefixes
+of a few lengths, and the cost of an incremental add/remove.
+"""
+
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from autocomplete import PrefixIndex  # noqa: E402
+
+WORDS = ['The', 'Blue', 'Red', 'Golden', 'Little', 'Grand', 'Velvet', 'Electric',
+         'Moon', 'Hall', 'Room', 'Lounge', 'Club', 'Garden', 'Theatre', 'Bar',
+         'Pianos', 'Square', 'Hop', 'Cellar', 'Jazz', 'Rock', 'House', 'Stage']
+
+
+def names(count, seed=42):
+    rng = random.Random(seed)
+    for id in range(1, count + 1):
+        yield id, '{} {} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS),
+                                        rng.choice(WORDS), id)
+
+
+def per_call(fn, args, repeat):
+    started = time.perf_counter()
+    for arg in args * repeat:
+        fn(arg)
+    return (time.perf_counter() - started) / (len(args) * repeat) * 1e6
+
+
+def main(count=1000000):
+    # the names are generated inside the trace, so their strings count too
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = PrefixIndex(names(count))
+    built = time.perf_counter() - started
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:,} names: built in {:.2f}s, {:.1f} MiB held ({:.0f} B/name), '
+          '{:.1f} MiB peak while building'.format(
+              count, built, size / 2 ** 20, size / count, peak / 2 ** 20))
+
+    rng = random.Random(7)
+    for length in (1, 3, 8):
+        prefixes = [name[:length] for name in rng.sample(index._names, 200)]
+        print('complete(prefix of {} chars, limit=10): {:6.2f} us'.format(
+            length, per_call(lambda prefix: index.complete(prefix, 10), prefixes, 20)))
+
+    added = [(count + i, 'Velvet Cellar Jazz {}'.format(count + i)) for i in range(1, 1001)]
+    started = time.perf_counter()
+    for id, name in added:
+        index.add(id, name)
+    add_cost = (time.perf_counter() - started) / len(added) * 1e6
+    started = time.perf_counter()
+    for id, name in added:
+        index.remove(id, name)
+    remove_cost = (time.perf_counter() - started) / len(added) * 1e6
+    print('add: {:.1f} us, remove: {:.1f} us'.format(add_cost, remove_cost))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
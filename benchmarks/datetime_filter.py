@@ -0,0 +1,53 @@
+"""Per-row cost of the `datetime` Jinja filter, before and after memoizing.
+
+    python benchmarks/datetime_filter.py [rows]
+
+"before" is the original filter: dateutil parses an ISO string and
+babel.dates.format_datetime re-parses the pattern and the locale on every
+call. "after" is app.format_datetime fed the datetime the timestamp column
+now returns, and app.format_datetimes formatting the whole list at once.
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+import babel.dates
+import dateutil.parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import format_datetime, format_datetimes  # noqa: E402
+
+
+def legacy_format_datetime(value, format='medium'):
+    date = dateutil.parser.parse(value)
+    if format == 'full':
+        format = "EEEE MMMM, d, y 'at' h:mma"
+    elif format == 'medium':
+        format = "EE MM, dd, y h:mma"
+    return babel.dates.format_datetime(date, format)
+
+
+def main(rows=10000):
+    start = datetime(2019, 10, 10, 20, 0, tzinfo=timezone.utc)
+    stamps = [start + timedelta(hours=7 * i) for i in range(rows)]
+    strings = [stamp.isoformat() for stamp in stamps]
+    assert [legacy_format_datetime(s, 'full') for s in strings[:50]] == \
+        [format_datetime(s, 'full') for s in stamps[:50]]
+
+    cases = [
+        ('before: string + babel.dates.format_datetime',
+         lambda: [legacy_format_datetime(s, 'full') for s in strings]),
+        ('after: datetime + format_datetime',
+         lambda: [format_datetime(s, 'full') for s in stamps]),
+        ('after: format_datetimes (batch)',
+         lambda: format_datetimes(stamps, 'full')),
+    ]
+    for name, run in cases:
+        best = min(timeit.repeat(run, number=1, repeat=5))
+        print('{:<48} {:8.2f} us/row'.format(name, best / rows * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,334 @@
+"""Route benchmarks with SQL statement and latency budgets.
+
+    python benchmarks/routes.py [--size small|medium|large|all] [--iterations N]
+                                [--database URL] [--update-budgets]
+
+Seeds a synthetic catalog of the given size into a scratch database
+(SQLite next to this file unless --database is given), drives every route of
+app.py through the Flask test client and reports p50/p95/p99 latency and the
+number of SQL statements per request. Every request must succeed -- writes
+are checked for their success message or their new row, so a form that
+fails validation is not timed as a fast write. The run fails when a route
+issues more statements than budgets.json allows or its p95 is over budget;
+--update-budgets rewrites the file from the measurements instead.
+
+Statement counts are exact and portable between machines; the latency
+budgets are loose on purpose and only catch gross regressions.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUDGETS = os.path.join(HERE, 'budgets.json')
+# bearer token for /metrics; the other routes ignore the header
+METRICS_TOKEN = 'bench'
+
+# venues, artists, shows
+SIZES = {
+    'small': (50, 50, 500),
+    'medium': (500, 500, 10000),
+    'large': (5000, 5000, 100000),
+}
+STATES = ['CA', 'NY', 'TX', 'WA', 'IL', 'LA', 'MA', 'OR']
+GENRES = ['Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk', 'Funk',
+          'Hip-Hop', 'Heavy Metal', 'Instrumental', 'Jazz', 'Musical Theatre', 'Pop',
+          'Punk', 'R&B', 'Reggae', 'Rock n Roll', 'Soul', 'Other']
+WORDS = ['The', 'Blue', 'Red', 'Golden', 'Little', 'Grand', 'Velvet', 'Electric',
+         'Moon', 'Hall', 'Room', 'Lounge', 'Club', 'Garden', 'Theatre', 'Bar']
+
+
+def load_app(database):
+    os.environ['DATABASE_URL'] = database
+    os.environ.pop('DATABASE_REPLICA_URLS', None)
+    # caches are warmed by hand once each catalog is seeded
+    os.environ['WARM_CACHES'] = '0'
+    os.environ['METRICS_TOKEN'] = METRICS_TOKEN
+    sys.path.insert(0, os.path.join(HERE, '..'))
+    import app as fyyur
+    from cache import LRUBackend
+    fyyur.app.config['WTF_CSRF_ENABLED'] = False
+    # measure rendering, not the page cache
+    fyyur.response_cache.backend = LRUBackend(maxsize=0)
+    return fyyur
+
+
+def seed(fyyur, size, seed=1):
+    venue_count, artist_count, show_count = SIZES[size]
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    db = fyyur.db
+    tables = db.metadata.tables
+
+    def name(i):
+        return '{} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS), i)
+
+    db.drop_all()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        db.session.commit()
+    db.create_all()
+    with db.engine.begin() as connection:
+        connection.execute(tables['state'].insert(), [{'name': state} for state in STATES])
+        connection.execute(tables['genre'].insert(), [{'name': genre} for genre in GENRES])
+        connection.execute(tables['city'].insert(),
+                           [{'name': 'City {}'.format(i)} for i in range(1, 51)])
+        connection.execute(tables['address'].insert(),
+                           [{'name': '{} Main St'.format(i)} for i in range(1, venue_count + 1)])
+        for table, count in (('venue', venue_count), ('artist', artist_count)):
+            rows = []
+            for i in range(1, count + 1):
+                row = {'name': name(i), 'city_id': rng.randint(1, 50),
+                       'state_id': rng.randint(1, len(STATES)), 'phone': '555-000-0000',
+                       'image_link': 'https://img.example.com/{}/{}.png'.format(table, i),
+                       'facebook_link': 'https://facebook.com/{}{}'.format(table, i),
+                       'seeking_description': ''}
+                if table == 'venue':
+                    row.update(address_id=i, seeking_talent=rng.random() < 0.5)
+                else:
+                    row.update(seeking_venue=rng.random() < 0.5)
+                rows.append(row)
+            connection.execute(tables[table].insert(), rows)
+            connection.execute(tables[table + '_genres'].insert(), [
+                {table + '_id': i, 'genre_id': genre_id}
+                for i in range(1, count + 1)
+                for genre_id in rng.sample(range(1, len(GENRES) + 1), rng.randint(1, 3))])
+        shows = []
+        for i in range(show_count):
+            start_time = now + timedelta(minutes=rng.randint(-365 * 24 * 60, 365 * 24 * 60))
+            shows.append({'venue_id': rng.randint(1, venue_count),
+                          'artist_id': rng.randint(1, artist_count),
+                          'start_time': start_time, 'end_time': start_time + timedelta(hours=2),
+                          'counted_as_upcoming': start_time > now})
+        connection.execute(tables['show'].insert(), shows)
+    fyyur.reconcileShowCounts(now)
+
+    # the busiest venue and artist make the detail pages the worst case
+    show = fyyur.Show
+    busiest = {}
+    for column in (show.venue_id, show.artist_id):
+        busiest[column.key] = db.session.query(column).group_by(column) \
+            .order_by(fyyur.func.count().desc(), column).limit(1).scalar()
+    db.session.remove()
+    fyyur.lookups.clear()
+    fyyur.warmCaches()
+    fyyur.loadCompletions()
+    return busiest
+
+
+def venue_form(name):
+    return {'name': name, 'city': 'City 1', 'state': 'CA', 'address': '1 Bench St',
+            'phone': '555-000-0000', 'genres': ['Jazz', 'Blues'],
+            'facebook_link': 'https://facebook.com/bench', 'image_link': 'https://img.example.com/b.png',
+            'website': 'https://example.com', 'seeking_talent': '1', 'seeking_description': 'x'}
+
+
+def artist_form(name):
+    return {'name': name, 'city': 'City 1', 'state': 'CA', 'phone': '555-000-0000',
+            'genres': ['Jazz'], 'facebook_link': 'https://facebook.com/bench',
+            'image_link': 'https://img.example.com/b.png', 'website': 'https://example.com',
+            'seeking_venue': '0', 'seeking_description': ''}
+
+
+def routes(fyyur, ids):
+    """(name, method, request, verify) where request(i) -> (url, form data); it
+    may prepare rows for the request, which is not counted or timed.
+    verify(response, i), when given, says whether a write did what it should;
+    it runs after the request has been counted and timed."""
+    venue_id, artist_id = ids['venue_id'], ids['artist_id']
+    far_future = datetime(2100, 1, 1)
+
+    def get(url):
+        return lambda i: (url, None)
+
+    def deletable_venue(i):
+        venue = fyyur.Venue(name='Bench Delete {}'.format(i), city_id=1, state_id=1, address_id=1)
+        fyyur.db.session.add(venue)
+        fyyur.db.session.commit()
+        venue_id = venue.id
+        fyyur.db.session.remove()
+        return '/venues/{}'.format(venue_id), None
+
+    def flashed(message):
+        # the views that render home.html show their flash on that very page
+        return lambda response, i: message in response.get_data(as_text=True)
+
+    def renamed(model, id, name):
+        # the edit views redirect either way; the row tells whether it worked
+        def verify(response, i):
+            with fyyur.app.app_context():
+                stored = fyyur.db.session.query(model.name).filter_by(id=id).scalar()
+                fyyur.db.session.remove()
+            return response.status_code == 302 and stored == name.format(i)
+        return verify
+
+    return [
+        ('index', 'GET', get('/'), None),
+        ('venues', 'GET', get('/venues'), None),
+        ('search_venues', 'POST', lambda i: ('/venues/search', {'search_term': 'hall'}), None),
+        ('show_venue', 'GET', get('/venues/{}'.format(venue_id)), None),
+        ('create_venue_form', 'GET', get('/venues/create'), None),
+        ('create_venue_submission', 'POST',
+         lambda i: ('/venues/create', venue_form('Bench Venue {}'.format(i))),
+         flashed('was successfully listed!')),
+        ('delete_venue', 'DELETE', deletable_venue, flashed('successfully deleted.')),
+        ('artists', 'GET', get('/artists'), None),
+        ('search_artists', 'POST', lambda i: ('/artists/search', {'search_term': 'moon'}), None),
+        ('show_artist', 'GET', get('/artists/{}'.format(artist_id)), None),
+        ('edit_artist', 'GET', get('/artists/{}/edit'.format(artist_id)), None),
+        ('edit_artist_submission', 'POST', lambda i: (
+            '/artists/{}/edit'.format(artist_id), artist_form('Bench Artist {}'.format(i))),
+         renamed(fyyur.Artist, artist_id, 'Bench Artist {}')),
+        ('edit_venue', 'GET', get('/venues/{}/edit'.format(venue_id)), None),
+        ('edit_venue_submission', 'POST', lambda i: (
+            '/venues/{}/edit'.format(venue_id), venue_form('Bench Venue Edit {}'.format(i))),
+         renamed(fyyur.Venue, venue_id, 'Bench Venue Edit {}')),
+        ('create_artist_form', 'GET', get('/artists/create'), None),
+        ('create_artist_submission', 'POST',
+         lambda i: ('/artists/create', artist_form('Bench Artist New {}'.format(i))),
+         flashed('was successfully listed!')),
+        ('shows', 'GET', get('/shows'), None),
+        ('shows_next30_city', 'GET', get('/shows?preset=next30&city=City+7'), None),
+        ('create_shows', 'GET', get('/shows/create'), None),
+        ('create_show_submission', 'POST', lambda i: ('/shows/create', {
+            'venue_id': venue_id, 'artist_id': artist_id, 'duration': 60,
+            'start_time': (far_future + timedelta(days=i)).strftime('%Y-%m-%d %H:%M:%S')}),
+         flashed('Show was successfully listed!')),
+        ('export_shows_csv', 'GET', get('/export/shows.csv'), None),
+        ('export_venues_ndjson', 'GET', get('/export/venues.ndjson'), None),
+        ('export_artists_csv', 'GET', get('/export/artists.csv'), None),
+        ('api_venues', 'GET', get('/api/v1/venues?fields=id,name,city,genres'), None),
+        ('api_venue', 'GET', get('/api/v1/venues/{}'.format(venue_id)), None),
+        ('api_artists', 'GET', get('/api/v1/artists'), None),
+        ('api_artist', 'GET', get('/api/v1/artists/{}'.format(artist_id)), None),
+        ('api_shows', 'GET', get('/api/v1/shows'), None),
+        ('api_search_venues', 'GET', get('/api/v1/venues/search?q=hall'), None),
+        ('api_search_artists', 'GET', get('/api/v1/artists/search?q=moon'), None),
+        ('api_show_conflicts', 'GET', get('/api/v1/shows/conflicts'), None),
+        ('autocomplete', 'GET', get('/autocomplete?q=gold'), None),
+        ('cache_stats', 'GET', get('/cache/stats'), None),
+        ('metrics', 'GET', get('/metrics'), None),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def measure(fyyur, ids, iterations, warmup=2):
+    from sqlalchemy import event
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    with fyyur.app.app_context():
+        engine = fyyur.db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    results = {}
+    try:
+        for name, method, request, verify in routes(fyyur, ids):
+            timings, counts = [], []
+            for i in range(warmup + iterations):
+                with fyyur.app.app_context():
+                    url, data = request(i)
+                # a fresh client each time: no session, no flashed messages
+                client = fyyur.app.test_client()
+                statements[0] = 0
+                started = time.perf_counter()
+                response = client.open(url, method=method, data=data, headers={
+                    'Authorization': 'Bearer ' + METRICS_TOKEN})
+                response.get_data()
+                elapsed = time.perf_counter() - started
+                queries = statements[0]
+                if response.status_code >= 400:
+                    raise SystemExit('{} {} returned {}'.format(method, url, response.status_code))
+                if verify is not None and not verify(response, i):
+                    raise SystemExit('{} {} did not succeed (status {})'.format(
+                        method, url, response.status_code))
+                if i >= warmup:
+                    timings.append(elapsed * 1000)
+                    counts.append(queries)
+            results[name] = {
+                'queries': max(counts),
+                'p50_ms': round(percentile(timings, 0.50), 2),
+                'p95_ms': round(percentile(timings, 0.95), 2),
+                'p99_ms': round(percentile(timings, 0.99), 2),
+            }
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return results
+
+
+def check(size, results, budgets):
+    failures = []
+    print('\n{} catalog: {} venues, {} artists, {} shows'.format(size, *SIZES[size]))
+    print('{:<26} {:>8} {:>8} {:>8} {:>8}  {}'.format(
+        'route', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'budget'))
+    for name, result in results.items():
+        budget = budgets.get(size, {}).get(name)
+        status = 'no budget'
+        if budget:
+            over = []
+            if result['queries'] > budget['queries']:
+                over.append('queries > {}'.format(budget['queries']))
+            if result['p95_ms'] > budget['p95_ms']:
+                over.append('p95 > {} ms'.format(budget['p95_ms']))
+            status = 'OVER: ' + ', '.join(over) if over else 'ok'
+            if over:
+                failures.append('{}/{}: {}'.format(size, name, ', '.join(over)))
+        print('{:<26} {:>8} {:>8} {:>8} {:>8}  {}'.format(
+            name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['queries'], status))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', choices=sorted(SIZES) + ['all'], default='small')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--database', help='database URL (default: SQLite in benchmarks/)')
+    parser.add_argument('--budgets', default=BUDGETS)
+    parser.add_argument('--update-budgets', action='store_true')
+    args = parser.parse_args()
+
+    database = args.database or 'sqlite:///' + os.path.join(HERE, 'routes.sqlite')
+    fyyur = load_app(database)
+    budgets = {}
+    if os.path.exists(args.budgets):
+        with open(args.budgets) as f:
+            budgets = json.load(f)
+
+    failures = []
+    sizes = ['small', 'medium', 'large'] if args.size == 'all' else [args.size]
+    for size in sizes:
+        with fyyur.app.app_context():
+            ids = seed(fyyur, size)
+        results = measure(fyyur, ids, args.iterations)
+        if args.update_budgets:
+            # statements exactly; latency with plenty of headroom
+            budgets[size] = dict((name, {
+                'queries': result['queries'],
+                'p95_ms': float(math.ceil(result['p95_ms'] * 3 + 20)),
+            }) for name, result in results.items())
+        failures += check(size, results, budgets)
+
+    if args.update_budgets:
+        with open(args.budgets, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('\nwrote ' + args.budgets)
+    elif failures:
+        print('\nover budget:\n  ' + '\n  '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#----------------------------------------------------------------------------#
+# Response cache for rendered pages, keyed by entity ("venue:42").
+#
+# Backends share a tiny get/set/delete interface: LRUBackend keeps entries in
+# the worker process, SharedStoreBackend talks to anything with the redis-py
+# get/set/delete methods (a Redis server, or a local stand-in in tests).
+#----------------------------------------------------------------------------#
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUBackend(object):
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class SharedStoreBackend(object):
+
+    def __init__(self, client, ttl=60, prefix='fyyur:page:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "RESPONSE_CACHE_BACKEND='redis' needs the redis package "
+                "(pip install redis)")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+
+class ResponseCache(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, *keys):
+        self.backend.delete(*keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+def make_backend(config):
+    ttl = config['RESPONSE_CACHE_TTL']
+    if config['RESPONSE_CACHE_BACKEND'] == 'redis':
+        return SharedStoreBackend.from_url(config['RESPONSE_CACHE_URL'], ttl=ttl)
+    return LRUBackend(config['RESPONSE_CACHE_SIZE'], ttl)
@@ -1,14 +1,14 @@
 from datetime import datetime
+from flask import current_app
 from flask_wtf import FlaskForm
 from enum import Enum
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, TextField, RadioField
-from wtforms.validators import DataRequired, AnyOf, URL, Length, NumberRange
-
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, IntegerField, TextField, RadioField
+from wtforms.validators import DataRequired, AnyOf, URL, Length, NumberRange, Optional, ValidationError
 class ShowForm(FlaskForm):
-    artist_id = StringField(
+    artist_id = IntegerField(
         'artist_id'
     )
-    venue_id = StringField(
+    venue_id = IntegerField(
         'venue_id'
     )
     start_time = DateTimeField(
@@ -16,6 +16,16 @@ class ShowForm(FlaskForm):
         validators=[DataRequired()],
         default= datetime.today()
     )
+    duration = IntegerField(
+        'duration',
+        validators=[Optional(), NumberRange(min=1)],
+        default=lambda: current_app.config['SHOW_DURATION_MINUTES']
+    )
+
+    def validate_duration(self, field):
+        longest = current_app.config['SHOW_MAX_DURATION_MINUTES']
+        if field.data is not None and field.data > longest:
+            raise ValidationError('A show can last at most {} minutes.'.format(longest))
 
 class VenueForm(FlaskForm):
     name = StringField(
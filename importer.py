@@ -0,0 +1,315 @@
+#----------------------------------------------------------------------------#
+# Streaming bulk import of venues, artists and shows from CSV / NDJSON.
+#
+# Records are read lazily and handled in chunks: lookup names are resolved
+# with one upsert per table per chunk, rows are written with COPY on
+# Postgres and executemany elsewhere (venues and artists one INSERT at a time,
+# for their generated ids), and every chunk is its own
+# transaction. Records that cannot be parsed or written are appended to a
+# reject file instead of aborting the load.
+#----------------------------------------------------------------------------#
+
+import csv
+import io
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+import dateutil.parser
+from sqlalchemy import select, text
+
+from lookups import upsert_names
+
+# entity -> how to turn a record into a row
+ENTITIES = {
+    'venues': {
+        'table': 'venue',
+        'required': ['name'],
+        'columns': ['name', 'phone', 'image_link', 'facebook_link', 'website',
+                    'seeking_talent', 'seeking_description'],
+        'booleans': ['seeking_talent'],
+        'lookups': {'city': 'city_id', 'state': 'state_id', 'address': 'address_id'},
+        'genres': ('venue_genres', 'venue_id'),
+    },
+    'artists': {
+        'table': 'artist',
+        'required': ['name'],
+        'columns': ['name', 'phone', 'image_link', 'facebook_link', 'website',
+                    'seeking_venue', 'seeking_description'],
+        'booleans': ['seeking_venue'],
+        'lookups': {'city': 'city_id', 'state': 'state_id'},
+        'genres': ('artist_genres', 'artist_id'),
+    },
+    'shows': {
+        'table': 'show',
+        'required': ['venue_id', 'artist_id', 'start_time'],
+        'columns': ['venue_id', 'artist_id', 'start_time', 'end_time'],
+        'booleans': [],
+        'lookups': {},
+        'genres': None,
+    },
+}
+
+TRUE = ('1', 'true', 't', 'yes', 'y')
+FALSE = ('', '0', 'false', 'f', 'no', 'n')
+
+
+def read_records(stream, format):
+    """Yield (line number, record dict) from a CSV or NDJSON text stream."""
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif format == 'ndjson':
+        for line_num, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError as err:
+                    record = {'_raw': line.rstrip('\n'), '_error': str(err)}
+                yield line_num, record
+    else:
+        raise ValueError('unknown format {!r}'.format(format))
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_bool(value):
+    if isinstance(value, bool) or value is None:
+        return bool(value)
+    value = str(value).strip().lower()
+    if value in TRUE:
+        return True
+    if value in FALSE:
+        return False
+    raise ValueError('not a boolean: {!r}'.format(value))
+
+
+def parse_genres(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(';')
+    return [genre.strip() for genre in value if genre.strip()]
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.imported = 0
+        self.rejected = 0
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return (self.imported + self.rejected) / max(self.elapsed, 1e-9)
+
+
+class Importer(object):
+
+    def __init__(self, connection, metadata, entity, chunk_size=5000,
+                 rejects=None, on_chunk=None, progress=None, show_duration=timedelta(hours=2),
+                 max_show_duration=timedelta(hours=24)):
+        self.connection = connection
+        self.spec = ENTITIES[entity]
+        self.entity = entity
+        self.table = metadata.tables[self.spec['table']]
+        self.tables = metadata.tables
+        self.chunk_size = chunk_size
+        self.rejects = rejects
+        # on_chunk(connection, entity, rows) runs inside each chunk's transaction
+        self.on_chunk = on_chunk
+        self.progress = progress
+        # end_time of shows that only give a start_time, and the longest show
+        self.show_duration = show_duration
+        self.max_show_duration = max_show_duration
+        self.stats = ImportStats()
+
+    def run(self, records):
+        for chunk in chunked(records, self.chunk_size):
+            rows = []
+            for line, record in chunk:
+                try:
+                    rows.append((line, record, self.parse(record)))
+                except (KeyError, TypeError, ValueError, OverflowError) as err:
+                    self.reject(line, record, err)
+            rows = self.resolve(rows)
+            self.write(rows)
+            if self.progress:
+                self.progress(self.stats)
+        return self.stats
+
+    def reject(self, line, record, error):
+        self.stats.rejected += 1
+        if self.rejects is not None:
+            self.rejects.write(json.dumps(
+                {'line': line, 'error': str(error), 'record': record}, default=str) + '\n')
+
+    def parse(self, record):
+        if '_error' in record:
+            raise ValueError(record['_error'])
+        for field in self.spec['required'] + list(self.spec['lookups']):
+            if not record.get(field):
+                raise ValueError('missing {}'.format(field))
+
+        row = {}
+        for column in self.spec['columns']:
+            value = record.get(column)
+            if column in self.spec['booleans']:
+                value = parse_bool(value)
+            elif column in ('venue_id', 'artist_id'):
+                value = int(value)
+            elif column == 'end_time' and not value:
+                value = row['start_time'] + self.show_duration
+            elif column in ('start_time', 'end_time'):
+                value = dateutil.parser.parse(value) if isinstance(value, str) else value
+                if value.tzinfo is None:
+                    value = value.replace(tzinfo=timezone.utc)
+            elif value == '':
+                value = None
+            row[column] = value
+        for field in self.spec['lookups']:
+            row[field] = record[field].strip()
+        if self.spec['genres']:
+            row['genres'] = parse_genres(record.get('genres'))
+        if self.entity == 'shows':
+            if not timedelta(0) < row['end_time'] - row['start_time'] <= self.max_show_duration:
+                raise ValueError('end_time must be after start_time, by at most {:.0f} minutes'
+                                 .format(self.max_show_duration.total_seconds() / 60))
+            row['counted_as_upcoming'] = row['start_time'] > datetime.now(timezone.utc)
+        return row
+
+    def resolve(self, rows):
+        """Swap lookup names for ids, and drop shows whose venue/artist is unknown."""
+        if not rows:
+            return rows
+        try:
+            with self.connection.begin():
+                resolved, rejected = self.resolve_chunk(rows)
+        except Exception as err:
+            if len(rows) == 1:
+                self.reject(rows[0][0], rows[0][1], err)
+                return []
+            resolved = []
+            for row in rows:
+                resolved += self.resolve([row])
+            return resolved
+        # only once the chunk went through: a retried chunk rejects its rows again
+        for line, record, error in rejected:
+            self.reject(line, record, error)
+        return resolved
+
+    def resolve_chunk(self, rows):
+        """(resolved rows, [(line, record, error)] of the rows to reject)"""
+        resolved = [(line, record, dict(row)) for line, record, row in rows]
+        rejected = []
+        for field, column in self.spec['lookups'].items():
+            ids = upsert_names(self.connection, self.tables[field],
+                               [row[field] for _, _, row in resolved])
+            for _, _, row in resolved:
+                row[column] = ids[row.pop(field)]
+        if self.spec['genres']:
+            ids = upsert_names(self.connection, self.tables['genre'],
+                               [genre for _, _, row in resolved for genre in row['genres']])
+            for _, _, row in resolved:
+                row['genres'] = sorted(set(ids[genre] for genre in row['genres']))
+
+        if self.entity == 'shows':
+            known = {}
+            for key in ('venue_id', 'artist_id'):
+                table = self.tables[key.split('_')[0]]
+                wanted = set(row[key] for _, _, row in resolved)
+                known[key] = set(id for id, in self.connection.execute(
+                    select([table.c.id]).where(table.c.id.in_(wanted))))
+            shows = []
+            for line, record, row in resolved:
+                missing = [key for key in known if row[key] not in known[key]]
+                if missing:
+                    rejected.append((line, record, 'unknown ' + ', '.join(missing)))
+                else:
+                    shows.append((line, record, row))
+            resolved = shows
+        return resolved, rejected
+
+    def write(self, rows):
+        if not rows:
+            return
+        try:
+            with self.connection.begin():
+                self.insert([row for _, _, row in rows])
+            self.stats.imported += len(rows)
+        except Exception:
+            # find the offending records one by one
+            for line, record, row in rows:
+                try:
+                    with self.connection.begin():
+                        self.insert([row])
+                    self.stats.imported += 1
+                except Exception as err:
+                    self.reject(line, record, err)
+
+    def insert(self, rows):
+        genres = self.spec['genres']
+        # a retried row may carry the id given to it by its failed chunk
+        columns = [column for column in rows[0] if column not in ('genres', 'id')]
+        if not genres:
+            self.bulk_insert(self.table, columns, rows)
+        elif self.connection.dialect.name == 'postgresql':
+            for row, id in zip(rows, self.allocate_ids(len(rows))):
+                row['id'] = id
+            self.bulk_insert(self.table, columns + ['id'], rows)
+        else:
+            # no sequence to reserve ids from: insert the rows one by one and
+            # let the database number them, so rows the app writes during an
+            # import never collide with them
+            for row in rows:
+                row['id'] = self.connection.execute(
+                    self.table.insert(), dict((column, row[column]) for column in columns)
+                ).inserted_primary_key[0]
+
+        if genres:
+            table, owner = genres
+            links = [{owner: row['id'], 'genre_id': genre_id}
+                     for row in rows for genre_id in row['genres']]
+            if links:
+                self.bulk_insert(self.tables[table], [owner, 'genre_id'], links)
+        if self.on_chunk:
+            self.on_chunk(self.connection, self.entity, rows)
+
+    def allocate_ids(self, count):
+        """Reserve `count` ids from the table's Postgres sequence."""
+        result = self.connection.execute(
+            text('SELECT nextval(pg_get_serial_sequence(:table, \'id\')) '
+                 'FROM generate_series(1, :count)'),
+            {'table': self.table.name, 'count': count})
+        return [id for id, in result]
+
+    def bulk_insert(self, table, columns, rows):
+        if self.connection.dialect.name != 'postgresql':
+            self.connection.execute(
+                table.insert(), [dict((column, row[column]) for column in columns) for row in rows])
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                table.name, ', '.join(columns)), buffer)
+        finally:
+            cursor.close()
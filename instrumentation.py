@@ -0,0 +1,127 @@
+#----------------------------------------------------------------------------#
+# Per-request SQL instrumentation.
+#
+# Engine events count and time every statement run while a request is being
+# handled, on the primary and the replicas alike. Each response carries the
+# totals in a Server-Timing header, and a request that runs too many
+# statements, spends too long in the database or repeats one statement shape
+# (the signature of an N+1 loop) is logged as a warning with its route and
+# the statement.
+#----------------------------------------------------------------------------#
+
+import re
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# bound parameters in the styles of the drivers we use, and expanded IN lists
+PARAMETER = re.compile(r"\?|%\(\w+\)s|%s|:\w+|\$\d+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PARAMETER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def statement_shape(statement):
+    shape = PARAMETER.sub('?', statement)
+    return ' '.join(PARAMETER_LIST.sub('(?)', shape).split())
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = Counter()
+        self.count = 0
+        self.duration = 0.0
+
+    def record(self, statement, duration):
+        self.statements[statement] += 1
+        self.count += 1
+        self.duration += duration
+
+    def repeated(self):
+        """(shape, count) of the statement shape run most often."""
+        shapes = Counter()
+        for statement, count in self.statements.items():
+            shapes[statement_shape(statement)] += count
+        return shapes.most_common(1)[0] if shapes else (None, 0)
+
+
+class SQLInstrumentation(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.app = app
+        self.enabled = config.get('SQL_INSTRUMENTATION', True)
+        self.max_statements = config.get('SQL_WARN_STATEMENTS', 30)
+        self.max_duration = config.get('SQL_WARN_MS', 200) / 1000.0
+        self.max_repeats = config.get('SQL_WARN_REPEATS', 5)
+        if not self.enabled:
+            return
+
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'handle_error', self.handle_error)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.sql_stats = RequestStats()
+
+    @staticmethod
+    def current(conn):
+        # the request's stats; asgi.py hangs its own on the connection
+        if has_request_context():
+            return g.get('sql_stats')
+        return conn.info.get('sql_stats')
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current(conn) is not None:
+            conn.info.setdefault('sql_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('sql_started')
+        stats = self.current(conn)
+        if started and stats is not None:
+            stats.record(statement, time.perf_counter() - started.pop())
+
+    def handle_error(self, context):
+        # a failed statement gets no after_cursor_execute: take its start off
+        # the connection, or the next statement would be timed from it
+        conn = context.connection
+        started = conn.info.get('sql_started') if conn is not None else None
+        if started:
+            stats = self.current(conn)
+            duration = time.perf_counter() - started.pop()
+            if stats is not None and context.statement is not None:
+                stats.record(context.statement, duration)
+
+    def finish(self, response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+        for timing in self.report(stats, request.method, request.path, request.endpoint):
+            response.headers.add('Server-Timing', timing)
+        return response
+
+    def report(self, stats, method, path, endpoint):
+        """Log what is wrong with a finished request; its Server-Timing values."""
+        elapsed = time.perf_counter() - stats.started
+        shape, repeats = stats.repeated()
+        problems = []
+        if stats.count > self.max_statements:
+            problems.append('{} statements'.format(stats.count))
+        if stats.duration > self.max_duration:
+            problems.append('{:.0f} ms in SQL'.format(stats.duration * 1000))
+        if repeats >= self.max_repeats:
+            problems.append('possible N+1: same statement {} times'.format(repeats))
+        if problems:
+            self.app.logger.warning('%s %s (%s): %s; most repeated statement: %s',
+                                    method, path, endpoint, ', '.join(problems), shape)
+        return ['sql;dur={:.1f};desc="{} statements"'.format(stats.duration * 1000, stats.count),
+                'app;dur={:.1f}'.format(elapsed * 1000)]
@@ -0,0 +1,135 @@
+#----------------------------------------------------------------------------#
+# Per-worker cache of the small name -> id lookup tables
+# (city, state, address, genre).
+#----------------------------------------------------------------------------#
+
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+
+class NameCache(object):
+    """name -> id map, optionally bounded with least-recently-used eviction."""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, name):
+        with self._lock:
+            id = self._ids.get(name)
+            if id is not None and self.maxsize:
+                self._ids.move_to_end(name)
+            return id
+
+    def put(self, name, id):
+        with self._lock:
+            self._ids[name] = id
+            if self.maxsize:
+                self._ids.move_to_end(name)
+                while len(self._ids) > self.maxsize:
+                    self._ids.popitem(last=False)
+
+    def after_fork(self):
+        # a lock another thread of the parent held at the fork stays locked
+        self._lock = Lock()
+
+
+class LookupCache(object):
+    """One NameCache per table, warmed from the database when the worker
+    starts, or on first use if that has not happened.
+
+    Names in these tables are only ever added, so a cached id never goes
+    stale; a miss simply falls through to the database.
+    """
+
+    def __init__(self, maxsizes=None):
+        self.maxsizes = maxsizes or {}
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+        self._lock = Lock()
+
+    def is_warm(self, table):
+        return table in self._tables
+
+    def warm(self, table, rows):
+        cache = NameCache(self.maxsizes.get(table))
+        for name, id in rows:
+            cache.put(name, id)
+        with self._lock:
+            self._tables[table] = cache
+
+    def get(self, table, name):
+        cache = self._tables.get(table)
+        id = cache.get(name) if cache is not None else None
+        if id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return id
+
+    def put(self, table, name, id):
+        cache = self._tables.get(table)
+        if cache is not None:
+            cache.put(name, id)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    def after_fork(self):
+        self._lock = Lock()
+        for cache in self._tables.values():
+            cache.after_fork()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sizes': dict((table, len(cache)) for table, cache in self._tables.items()),
+        }
+
+
+def upsert_names(connection, table, names):
+    """Return {name: id} for `names`, inserting the ones that do not exist.
+
+    On Postgres this is a single INSERT ... ON CONFLICT (name) DO UPDATE
+    ... RETURNING statement; elsewhere missing names are inserted one by one
+    inside savepoints so a concurrent insert of the same name is tolerated.
+    """
+    # a stable order keeps concurrent upserts from deadlocking on row locks
+    names = sorted(set(names))
+    if not names:
+        return {}
+
+    if connection.dialect.name == 'postgresql':
+        stmt = pg_insert(table).values([{'name': name} for name in names])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.name], set_={'name': stmt.excluded.name})
+        rows = connection.execute(stmt.returning(table.c.name, table.c.id))
+        return dict(rows.fetchall())
+
+    def existing(names):
+        rows = connection.execute(
+            select([table.c.name, table.c.id]).where(table.c.name.in_(names)))
+        return dict(rows.fetchall())
+
+    ids = existing(names)
+    missing = [name for name in names if name not in ids]
+    for name in missing:
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(name=name))
+        except IntegrityError:
+            pass
+    if missing:
+        ids.update(existing(missing))
+    return ids
@@ -0,0 +1,170 @@
+#----------------------------------------------------------------------------#
+# Operator-only memory diagnostics, under /debug/memory.
+#
+# Starts and stops tracemalloc, keeps a few numbered snapshots and diffs two
+# of them by line, file or traceback, and counts the live ORM objects per
+# model and the size of the identity map of every live Session. All of it is
+# per worker: each response says which process answered.
+#
+# Every endpoint needs the operator's authorization (see RequestProfiler);
+# tracemalloc is only running between /start and /stop.
+#----------------------------------------------------------------------------#
+
+import gc
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from threading import Lock
+
+from flask import Blueprint, abort, jsonify, request
+from sqlalchemy.orm import Session
+
+GROUPINGS = ('lineno', 'filename', 'traceback')
+
+
+def rss_bytes():
+    """Current resident set size, or the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def statistic(stat, grouping):
+    frames = stat.traceback if grouping == 'traceback' else stat.traceback[:1]
+    return {
+        'where': ['{}:{}'.format(frame.filename, frame.lineno) if grouping != 'filename'
+                  else frame.filename for frame in frames],
+        'size': stat.size,
+        'size_diff': stat.size_diff,
+        'count': stat.count,
+        'count_diff': stat.count_diff,
+    }
+
+
+class MemoryDiagnostics(object):
+
+    def __init__(self, app=None, db=None, authorize=None):
+        if app is not None:
+            self.init_app(app, db, authorize)
+
+    def init_app(self, app, db, authorize):
+        self.db = db
+        self.authorize = authorize
+        self.max_snapshots = app.config.get('MEMORY_SNAPSHOTS', 5)
+        self.snapshots = OrderedDict()
+        self._next_id = 1
+        self._lock = Lock()
+
+        bp = Blueprint('memory', __name__, url_prefix='/debug/memory')
+        bp.before_request(self.check_authorized)
+        bp.add_url_rule('', 'status', self.status)
+        bp.add_url_rule('/objects', 'objects', self.objects)
+        bp.add_url_rule('/start', 'start', self.start, methods=['POST'])
+        bp.add_url_rule('/stop', 'stop', self.stop, methods=['POST'])
+        bp.add_url_rule('/snapshots', 'snapshot', self.snapshot, methods=['POST'])
+        bp.add_url_rule('/snapshots/<int:old>/diff/<int:new>', 'diff', self.diff)
+        app.register_blueprint(bp)
+
+    def check_authorized(self):
+        if self.authorize is None or not self.authorize():
+            abort(403)
+
+    def respond(self, **data):
+        return jsonify(pid=os.getpid(), **data)
+
+    def error(self, status, message):
+        response = self.respond(error=message)
+        response.status_code = status
+        return response
+
+    def status(self):
+        current, peak = tracemalloc.get_traced_memory()
+        return self.respond(
+            rss=rss_bytes(),
+            tracemalloc={'tracing': tracemalloc.is_tracing(),
+                         'frames': tracemalloc.get_traceback_limit(),
+                         'traced': current, 'peak': peak,
+                         'overhead': tracemalloc.get_tracemalloc_memory()},
+            snapshots=[{'id': id, 'taken_at': taken_at, 'traced': snapshot_size}
+                       for id, (taken_at, snapshot_size, _) in self.snapshots.items()],
+            gc={'counts': gc.get_count(), 'garbage': len(gc.garbage)})
+
+    def objects(self):
+        """Live instances per mapped model, and live Sessions with the size
+        of their identity maps."""
+        models = dict((mapper.class_, mapper.class_.__name__)
+                      for mapper in self.db.Model.registry.mappers)
+        instances = Counter()
+        detached = Counter()
+        stateless = Counter()
+        sessions = []
+        gc.collect()
+        for obj in gc.get_objects():
+            cls = type(obj)
+            if cls in models:
+                name = models[cls]
+                instances[name] += 1
+                state = obj.__dict__.get('_sa_instance_state')
+                if state is None:
+                    # the ORM state was deleted from the instance's __dict__
+                    stateless[name] += 1
+                elif state.session_id is None:
+                    detached[name] += 1
+            elif isinstance(obj, Session):
+                sessions.append({'identity_map': len(obj.identity_map),
+                                 'new': len(obj.new), 'dirty': len(obj.dirty),
+                                 'deleted': len(obj.deleted)})
+        return self.respond(
+            models=dict((name, {'instances': instances[name], 'detached': detached[name],
+                                'without_state': stateless[name]})
+                        for name in sorted(instances)),
+            sessions=sessions)
+
+    def start(self):
+        frames = request.args.get('frames', 1, type=int)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        tracemalloc.start(max(1, min(frames, 50)))
+        return self.status()
+
+    def stop(self):
+        tracemalloc.stop()
+        with self._lock:
+            self.snapshots.clear()
+        return self.status()
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            return self.error(409, 'tracemalloc is not running; POST /debug/memory/start first')
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+            self.snapshots[id] = (time.time(), tracemalloc.get_traced_memory()[0], snapshot)
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+        return self.respond(id=id, snapshots=list(self.snapshots))
+
+    def diff(self, old, new):
+        grouping = request.args.get('group', 'lineno')
+        if grouping not in GROUPINGS:
+            return self.error(400, 'group must be one of ' + ', '.join(GROUPINGS))
+        limit = request.args.get('limit', 25, type=int)
+        if old not in self.snapshots or new not in self.snapshots:
+            return self.error(404, 'no such snapshot in this worker')
+        stats = self.snapshots[new][2].compare_to(self.snapshots[old][2], grouping)
+        return self.respond(
+            old=old, new=new, group=grouping,
+            size_diff=sum(stat.size_diff for stat in stats),
+            count_diff=sum(stat.count_diff for stat in stats),
+            top=[statistic(stat, grouping) for stat in stats[:max(1, limit)]])
@@ -0,0 +1,169 @@
+#----------------------------------------------------------------------------#
+# Prometheus metrics, served at /metrics in the text exposition format.
+#
+# With PROMETHEUS_MULTIPROC_DIR set in the environment (before the app is
+# imported) every pre-forked worker writes its samples to files in that
+# directory and a scrape of any worker aggregates all of them; the directory
+# should be emptied when the server starts. Without it, each process reports
+# only its own numbers.
+#
+# Scrapes authenticate with the METRICS_TOKEN bearer token (Prometheus'
+# `authorization` scrape option) or the operator token.
+#----------------------------------------------------------------------------#
+
+import hmac
+import os
+import time
+
+from flask import Response, abort, g, request, template_rendered, before_render_template
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Gauge, Histogram, generate_latest)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+
+REQUEST_LATENCY = Histogram(
+    'fyyur_request_duration_seconds', 'Time to handle a request, by endpoint',
+    ['method', 'endpoint'])
+REQUESTS = Counter(
+    'fyyur_requests_total', 'Responses sent, by endpoint and status code',
+    ['method', 'endpoint', 'status'])
+TEMPLATE_RENDER = Histogram(
+    'fyyur_template_render_seconds', 'Time to render a template', ['template'])
+POOL_CHECKED_OUT = Gauge(
+    'fyyur_db_pool_checked_out', 'Connections checked out of the pool',
+    ['engine'], multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge(
+    'fyyur_db_pool_overflow', 'Connections open beyond the pool size',
+    ['engine'], multiprocess_mode='livesum')
+POOL_SIZE = Gauge(
+    'fyyur_db_pool_size', 'Configured pool size', ['engine'], multiprocess_mode='livesum')
+POOL_WAIT = Histogram(
+    'fyyur_db_pool_wait_seconds', 'Time to get a connection from the pool', ['engine'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+CACHE_REQUESTS = Counter(
+    'fyyur_cache_requests_total', 'Cache lookups, by cache and result', ['cache', 'result'])
+
+
+class CacheRatioCollector(object):
+    """Adds fyyur_cache_hit_ratio, worked out from the (aggregated) counters."""
+
+    def __init__(self, collector):
+        self.collector = collector
+
+    def collect(self):
+        totals = {}
+        for metric in self.collector.collect():
+            if metric.name == 'fyyur_cache_requests':
+                for sample in metric.samples:
+                    if sample.name.endswith('_total'):
+                        cache, result = sample.labels['cache'], sample.labels['result']
+                        totals.setdefault(cache, {})[result] = sample.value
+            yield metric
+        ratio = GaugeMetricFamily('fyyur_cache_hit_ratio', 'Share of cache lookups that hit',
+                                  labels=['cache'])
+        for cache, counts in sorted(totals.items()):
+            lookups = counts.get('hit', 0) + counts.get('miss', 0)
+            ratio.add_metric([cache], counts.get('hit', 0) / lookups if lookups else 0.0)
+        yield ratio
+
+
+class Metrics(object):
+
+    def __init__(self, app=None, engines=None, caches=None, authorize=None):
+        if app is not None:
+            self.init_app(app, engines, caches, authorize)
+
+    def init_app(self, app, engines=None, caches=None, authorize=None):
+        # caches: name -> object with `hits` and `misses` counts
+        self.token = app.config.get('METRICS_TOKEN')
+        self.authorize = authorize
+        self.caches = caches or {}
+        self._synced = dict((name, (0, 0)) for name in self.caches)
+        for name, engine in (engines or {}).items():
+            self.watch_pool(name, engine)
+
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            source = MultiProcessCollector(None)
+        else:
+            source = REGISTRY
+        self.registry = CollectorRegistry(auto_describe=False)
+        self.registry.register(CacheRatioCollector(source))
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        before_render_template.connect(self.template_started, app)
+        template_rendered.connect(self.template_finished, app)
+        app.add_url_rule('/metrics', 'metrics', self.expose)
+
+    def watch_pool(self, name, engine):
+        pool = engine.pool
+        if hasattr(pool, 'size'):
+            POOL_SIZE.labels(name).set(pool.size())
+
+        def update(*args):
+            if hasattr(pool, 'checkedout'):
+                POOL_CHECKED_OUT.labels(name).set(pool.checkedout())
+                POOL_OVERFLOW.labels(name).set(max(pool.overflow(), 0))
+
+        event.listen(pool, 'checkout', update)
+        event.listen(pool, 'checkin', update)
+
+        # pool events fire once a connection is handed out, so the wait is
+        # timed around the engine's raw_connection(), which every Connection uses
+        raw_connection = engine.raw_connection
+
+        def timed_raw_connection(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return raw_connection(*args, **kwargs)
+            finally:
+                POOL_WAIT.labels(name).observe(time.perf_counter() - started)
+
+        engine.raw_connection = timed_raw_connection
+
+    def start(self):
+        g.metrics_started = time.perf_counter()
+
+    def finish(self, response):
+        self.record(request.method, request.endpoint or 'unmatched', response.status_code,
+                    g.pop('metrics_started', None))
+        self.sync_caches()
+        return response
+
+    def record(self, method, endpoint, status, started=None):
+        """Count a response; asgi.py calls this for the API reads it answers."""
+        if started is not None:
+            REQUEST_LATENCY.labels(method, endpoint).observe(time.perf_counter() - started)
+        REQUESTS.labels(method, endpoint, str(status)).inc()
+
+    def sync_caches(self):
+        # the caches keep plain per-process counts; carry over what is new
+        for name, cache in self.caches.items():
+            hits, misses = self._synced[name]
+            if cache.hits > hits:
+                CACHE_REQUESTS.labels(name, 'hit').inc(cache.hits - hits)
+            if cache.misses > misses:
+                CACHE_REQUESTS.labels(name, 'miss').inc(cache.misses - misses)
+            self._synced[name] = (cache.hits, cache.misses)
+
+    def template_started(self, app, template, context, **extra):
+        g.setdefault('template_started', []).append(time.perf_counter())
+
+    def template_finished(self, app, template, context, **extra):
+        started = g.get('template_started')
+        if started:
+            TEMPLATE_RENDER.labels(template.name or 'string').observe(
+                time.perf_counter() - started.pop())
+
+    def check_authorized(self):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if (self.token and scheme.lower() == 'bearer'
+                and hmac.compare_digest(token.encode(), self.token.encode())):
+            return
+        if self.authorize is None or not self.authorize():
+            abort(403)
+
+    def expose(self):
+        self.check_authorized()
+        return Response(generate_latest(self.registry), content_type=CONTENT_TYPE_LATEST)
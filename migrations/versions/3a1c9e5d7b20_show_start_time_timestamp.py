@@ -0,0 +1,37 @@
+"""store show.start_time as timestamptz
+
+Revision ID: 3a1c9e5d7b20
+Revises: f5978620b111
+Create Date: 2026-10-18 09:12:41.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a1c9e5d7b20'
+down_revision = 'f5978620b111'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # legacy rows were written as naive ISO strings in UTC
+    op.alter_column('show', 'start_time',
+               existing_type=sa.String(),
+               type_=sa.DateTime(timezone=True),
+               existing_nullable=False,
+               postgresql_using="start_time::timestamp AT TIME ZONE 'UTC'")
+    op.create_index('ix_show_venue_id_start_time', 'show', ['venue_id', 'start_time'], unique=False)
+    op.create_index('ix_show_artist_id_start_time', 'show', ['artist_id', 'start_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_show_artist_id_start_time', table_name='show')
+    op.drop_index('ix_show_venue_id_start_time', table_name='show')
+    op.alter_column('show', 'start_time',
+               existing_type=sa.DateTime(timezone=True),
+               type_=sa.String(),
+               existing_nullable=False,
+               postgresql_using="to_char(start_time AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS')")
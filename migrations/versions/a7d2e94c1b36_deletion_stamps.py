@@ -0,0 +1,34 @@
+"""deletion stamps for the list pages' validators
+
+Revision ID: a7d2e94c1b36
+Revises: f3a8c1d6e290
+Create Date: 2026-10-19 09:41:17.302645
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d2e94c1b36'
+down_revision = 'f3a8c1d6e290'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    deletion = op.create_table('deletion',
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    # deletes made before now are unknown: date them to the upgrade
+    now = datetime.now(timezone.utc)
+    op.bulk_insert(deletion, [{'table_name': name, 'deleted_at': now}
+                              for name in ('venue', 'artist', 'show')])
+
+
+def downgrade():
+    op.drop_table('deletion')
@@ -0,0 +1,24 @@
+"""(start_time, id) index for keyset pagination of shows
+
+Revision ID: b72e0a4c5f18
+Revises: 8d4f2b6e1c93
+Create Date: 2026-10-18 10:41:09.530272
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b72e0a4c5f18'
+down_revision = '8d4f2b6e1c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_show_start_time_id', 'show', ['start_time', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_show_start_time_id', table_name='show')
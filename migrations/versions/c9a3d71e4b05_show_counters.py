@@ -0,0 +1,43 @@
+"""denormalised upcoming/past show counters
+
+Revision ID: c9a3d71e4b05
+Revises: b72e0a4c5f18
+Create Date: 2026-10-18 11:26:52.847310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9a3d71e4b05'
+down_revision = 'b72e0a4c5f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('show', sa.Column('counted_as_upcoming', sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.alter_column('show', 'counted_as_upcoming', server_default=None)
+    op.create_index('ix_show_rollover', 'show', ['start_time'], unique=False,
+                    postgresql_where=sa.text('counted_as_upcoming'))
+    for table in ('venue', 'artist'):
+        op.add_column(table, sa.Column('upcoming_shows_count', sa.Integer(), nullable=False, server_default='0'))
+        op.add_column(table, sa.Column('past_shows_count', sa.Integer(), nullable=False, server_default='0'))
+
+    op.execute('UPDATE show SET counted_as_upcoming = start_time > now()')
+    for table in ('venue', 'artist'):
+        op.execute(
+            'UPDATE {0} SET '
+            'upcoming_shows_count = (SELECT count(*) FROM show '
+            'WHERE show.{0}_id = {0}.id AND show.counted_as_upcoming), '
+            'past_shows_count = (SELECT count(*) FROM show '
+            'WHERE show.{0}_id = {0}.id AND NOT show.counted_as_upcoming)'.format(table))
+
+
+def downgrade():
+    for table in ('artist', 'venue'):
+        op.drop_column(table, 'past_shows_count')
+        op.drop_column(table, 'upcoming_shows_count')
+    op.drop_index('ix_show_rollover', table_name='show')
+    op.drop_column('show', 'counted_as_upcoming')
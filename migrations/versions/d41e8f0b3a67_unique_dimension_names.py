@@ -0,0 +1,57 @@
+"""deduplicate and enforce unique city/state/address/genre names
+
+Revision ID: d41e8f0b3a67
+Revises: c9a3d71e4b05
+Create Date: 2026-10-18 12:08:15.662941
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41e8f0b3a67'
+down_revision = 'c9a3d71e4b05'
+branch_labels = None
+depends_on = None
+
+# dimension table -> (referencing table, column)
+REFERENCES = {
+    'city': [('venue', 'city_id'), ('artist', 'city_id')],
+    'state': [('venue', 'state_id'), ('artist', 'state_id')],
+    'address': [('venue', 'address_id')],
+    'genre': [('venue_genres', 'genre_id'), ('artist_genres', 'genre_id')],
+}
+
+# every row mapped to the lowest id sharing its name
+SURVIVORS = '(SELECT id, min(id) OVER (PARTITION BY name) AS keep_id FROM {0}) AS survivor'
+
+
+def upgrade():
+    for table, references in REFERENCES.items():
+        for referencing, column in references:
+            op.execute(
+                'UPDATE {1} SET {2} = survivor.keep_id FROM {3} '
+                'WHERE {1}.{2} = survivor.id AND survivor.id <> survivor.keep_id'
+                .format(table, referencing, column, SURVIVORS.format(table)))
+        op.execute(
+            'DELETE FROM {0} USING {1} '
+            'WHERE {0}.id = survivor.id AND survivor.id <> survivor.keep_id'
+            .format(table, SURVIVORS.format(table)))
+        op.create_unique_constraint('{}_name_key'.format(table), table, ['name'])
+
+    # repointing can leave an owner linked to the same genre twice
+    for table, owner in (('venue_genres', 'venue_id'), ('artist_genres', 'artist_id')):
+        op.execute(
+            'DELETE FROM {0} a USING {0} b '
+            'WHERE a.ctid < b.ctid AND a.{1} = b.{1} AND a.genre_id = b.genre_id'
+            .format(table, owner))
+    op.create_unique_constraint('uq_venue_genres', 'venue_genres', ['venue_id', 'genre_id'])
+    op.create_unique_constraint('uq_artist_genres', 'artist_genres', ['artist_id', 'genre_id'])
+
+
+def downgrade():
+    op.drop_constraint('uq_artist_genres', 'artist_genres', type_='unique')
+    op.drop_constraint('uq_venue_genres', 'venue_genres', type_='unique')
+    for table in REFERENCES:
+        op.drop_constraint('{}_name_key'.format(table), table, type_='unique')
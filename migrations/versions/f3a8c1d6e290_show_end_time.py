@@ -0,0 +1,60 @@
+"""end_time on show, and no overlapping bookings per venue or artist
+
+Revision ID: f3a8c1d6e290
+Revises: e5b7c2a9d814
+Create Date: 2026-10-18 16:12:44.518203
+
+"""
+import logging
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8c1d6e290'
+down_revision = 'e5b7c2a9d814'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# shows that start before an earlier show of the same venue/artist has ended
+OVERLAPS = '''
+SELECT count(*) FROM (
+  SELECT start_time, max(end_time) OVER (
+    PARTITION BY {0} ORDER BY start_time, id
+    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS ended
+  FROM show) shows
+WHERE ended > start_time
+'''
+
+
+def upgrade():
+    op.add_column('show', sa.Column('end_time', sa.DateTime(timezone=True), nullable=True))
+    # existing shows get the same default length as new ones
+    op.execute(sa.text("UPDATE show SET end_time = start_time + :minutes * interval '1 minute'")
+               .bindparams(minutes=current_app.config['SHOW_DURATION_MINUTES']))
+    op.alter_column('show', 'end_time', nullable=False)
+    op.create_check_constraint('ck_show_end_after_start', 'show', 'end_time > start_time')
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    connection = op.get_bind()
+    for column in ('venue_id', 'artist_id'):
+        overlaps = connection.execute(sa.text(OVERLAPS.format(column))).scalar()
+        if overlaps:
+            # the constraint cannot be added over existing double bookings; clear
+            # them up (GET /api/v1/shows/conflicts), then add it by hand
+            logger.warning('Not adding ex_show_%s_overlap: %s overlapping shows.', column, overlaps)
+            continue
+        op.execute('ALTER TABLE show ADD CONSTRAINT ex_show_{0}_overlap '
+                   'EXCLUDE USING gist ({0} WITH =, tstzrange(start_time, end_time) WITH &&)'
+                   .format(column))
+
+
+def downgrade():
+    for column in ('artist_id', 'venue_id'):
+        op.execute('ALTER TABLE show DROP CONSTRAINT IF EXISTS ex_show_{}_overlap'.format(column))
+    op.drop_constraint('ck_show_end_after_start', 'show', type_='check')
+    op.drop_column('show', 'end_time')
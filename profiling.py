@@ -0,0 +1,157 @@
+#----------------------------------------------------------------------------#
+# On-demand sampling profiler for live requests.
+#
+# A request is profiled when it carries a token signed with PROFILE_SECRET
+# (`flask profile-token`), in the X-Profile header or the _profile query
+# argument, or when it is picked at PROFILE_SAMPLE_RATE. While the view runs,
+# a background thread samples the request thread's stack every
+# PROFILE_INTERVAL seconds, which covers the view, its SQL and the template
+# render alike; the stacks are written to PROFILE_DIR in the collapsed format
+# that flamegraph.pl and speedscope read. PROFILE_FORMAT = 'pstats' runs
+# cProfile instead (exact, but slows the request down) and writes a file for
+# pstats/snakeviz.
+#
+# With neither a secret nor a sample rate the hooks are not installed at all.
+#----------------------------------------------------------------------------#
+
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+TOKEN_HEADER = 'X-Profile'
+TOKEN_ARG = '_profile'
+
+
+def frame_name(frame):
+    module = frame.f_globals.get('__name__') or os.path.basename(frame.f_code.co_filename)
+    return '{}:{}'.format(module, frame.f_code.co_name)
+
+
+class StackSampler(object):
+    """Samples the stack of one thread from a helper thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write('{} {}\n'.format(stack, count))
+
+
+class FunctionProfiler(object):
+    """cProfile of the request thread, for PROFILE_FORMAT = 'pstats'."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class RequestProfiler(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.app = app
+        self.secret = config.get('PROFILE_SECRET')
+        self.sample_rate = config.get('PROFILE_SAMPLE_RATE', 0.0)
+        self.directory = config.get('PROFILE_DIR', 'profiles')
+        self.interval = config.get('PROFILE_INTERVAL', 0.005)
+        self.format = config.get('PROFILE_FORMAT', 'collapsed')
+        self.token_max_age = config.get('PROFILE_TOKEN_MAX_AGE', 3600)
+        # operator endpoints that take the token without asking for a profile
+        self.exempt_blueprints = set()
+        self.serializer = URLSafeTimedSerializer(self.secret, salt='profile') if self.secret else None
+        if not (self.serializer or self.sample_rate):
+            return
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.abandon)
+
+    def token(self):
+        return self.serializer.dumps('profile')
+
+    def authorized(self):
+        """Whether the request carries a valid operator token."""
+        token = request.headers.get(TOKEN_HEADER) or request.args.get(TOKEN_ARG)
+        if not token or self.serializer is None:
+            return False
+        try:
+            self.serializer.loads(token, max_age=self.token_max_age)
+        except BadSignature:
+            self.app.logger.warning('Rejected operator token for %s %s', request.method, request.path)
+            return False
+        return True
+
+    def start(self):
+        if request.blueprint in self.exempt_blueprints:
+            return
+        if not (self.authorized() or (self.sample_rate and random.random() < self.sample_rate)):
+            return
+        if self.format == 'pstats':
+            profiler = FunctionProfiler()
+        else:
+            profiler = StackSampler(threading.get_ident(), self.interval)
+        g.profiler = profiler
+        g.profile_started = time.perf_counter()
+        profiler.start()
+
+    def finish(self, response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.stop()
+        elapsed = time.perf_counter() - g.pop('profile_started')
+        name = '{}-{}-{}-{:.0f}ms.{}'.format(
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), request.endpoint or 'unmatched',
+            elapsed * 1000, 'pstats' if self.format == 'pstats' else 'collapsed')
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.write(os.path.join(self.directory, name))
+        response.headers['X-Profile-File'] = name
+        return response
+
+    def abandon(self, exception=None):
+        # the view raised before after_request ran: stop the sampler, keep nothing
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
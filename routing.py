@@ -0,0 +1,130 @@
+#----------------------------------------------------------------------------#
+# Read-replica routing.
+#
+# Views decorated with @replica_reads send their SELECTs to one of the
+# SQLALCHEMY_REPLICA_URIS; everything else, every flush, and every request
+# from a client that wrote within the last REPLICA_STICKY_SECONDS
+# (read-your-writes) stays on the primary.
+#
+# RoutingSession builds on Flask-SQLAlchemy 2.x's SignallingSession and
+# create_session, which 3.0 replaced; requirements.txt pins both it and
+# SQLAlchemy (whose select([...]) calls the app still uses) below 3 and 2.
+#----------------------------------------------------------------------------#
+
+import time
+from functools import wraps
+from threading import Lock
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+
+STICKY_COOKIE = 'fyyur_primary_until'
+
+
+class Replica(object):
+
+    def __init__(self, uri, engine_options=None, connect_timeout=None):
+        self.uri = uri
+        options = dict(engine_options or {})
+        if connect_timeout and uri.startswith('postgres'):
+            # a replica that stopped answering fails its check in seconds
+            # instead of holding a request until the OS gives up on the TCP
+            # connect; the check runs in the request that finds it due
+            options['connect_args'] = dict(options.get('connect_args', {}),
+                                           connect_timeout=connect_timeout)
+        self.engine = create_engine(uri, **options)
+        self.healthy = True
+        self.checked_at = None
+        self._lock = Lock()
+
+    def is_healthy(self, interval):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= interval:
+            # one request checks; the ones arriving meanwhile go by the
+            # last result rather than queueing behind it
+            if self._lock.acquire(blocking=False):
+                try:
+                    if self.checked_at is None or now - self.checked_at >= interval:
+                        self.healthy = self.ping()
+                        self.checked_at = time.monotonic()
+                finally:
+                    self._lock.release()
+        return self.healthy
+
+    def ping(self):
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            return False
+
+
+class ReplicaPool(object):
+    """Round-robin over the replicas that passed their last health check."""
+
+    def __init__(self, uris, check_interval=10, engine_options=None, connect_timeout=None):
+        self.replicas = [Replica(uri, engine_options, connect_timeout) for uri in uris]
+        self.check_interval = check_interval
+        self._next = 0
+        self._lock = Lock()
+
+    def engine(self):
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+            if replica.is_healthy(self.check_interval):
+                return replica.engine
+        # no replica configured or none healthy: fall back to the primary
+        return None
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get('read_replica'):
+            engine = self.app.extensions['replicas'].engine()
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+        app.extensions['replicas'] = ReplicaPool(
+            app.config.get('SQLALCHEMY_REPLICA_URIS', []),
+            app.config.get('REPLICA_HEALTH_CHECK_INTERVAL', 10),
+            app.config.get('SQLALCHEMY_ENGINE_OPTIONS'),
+            app.config.get('REPLICA_CONNECT_TIMEOUT'))
+
+        @event.listens_for(self.session, 'after_commit')
+        def wrote_to_primary(session):
+            if has_request_context():
+                g.wrote_to_primary = True
+
+        @app.after_request
+        def stick_to_primary(response):
+            if g.get('wrote_to_primary'):
+                sticky = app.config.get('REPLICA_STICKY_SECONDS', 5)
+                response.set_cookie(STICKY_COOKIE, str(time.time() + sticky),
+                                    max_age=sticky, httponly=True)
+            return response
+
+
+def replica_reads(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            primary_until = float(request.cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        g.read_replica = primary_until < time.time()
+        return view(*args, **kwargs)
+    return wrapper
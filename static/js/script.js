@@ -2,3 +2,19 @@ window.parseISOString = function parseISOString(s) {
   var b = s.split(/\D+/);
   return new Date(Date.UTC(b[0], --b[1], b[2], b[3], b[4], b[5], b[6]));
 };
+
+document.addEventListener('input', function (event) {
+  var input = event.target;
+  var kind = input.getAttribute && input.getAttribute('data-autocomplete');
+  if (!kind || !input.value.trim()) return;
+  var url = '/autocomplete?kinds=' + kind + '&limit=8&q=' + encodeURIComponent(input.value);
+  fetch(url).then(function (response) { return response.json(); }).then(function (data) {
+    var list = document.getElementById(input.getAttribute('list'));
+    list.innerHTML = '';
+    data[kind].forEach(function (match) {
+      var option = document.createElement('option');
+      option.value = match.name;
+      list.appendChild(option);
+    });
+  });
+});
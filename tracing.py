@@ -0,0 +1,350 @@
+#----------------------------------------------------------------------------#
+# Lightweight request tracing.
+#
+# A sampled request gets a trace: a span for the request, nested spans for
+# the view, each SQL statement, session commits, form validation, template
+# renders and whatever code wraps itself in span(). An incoming W3C
+# `traceparent` header continues the caller's trace (and its sampling
+# decision); other requests are sampled at TRACING_SAMPLE_RATE. Finished
+# traces are exported in the OTLP/JSON encoding, as one line per trace
+# appended to TRACING_FILE or kept in memory and served at /traces, to
+# requests the operator authorized (see RequestProfiler).
+#
+# Outside a sampled request span() costs a lookup on `g`.
+#----------------------------------------------------------------------------#
+
+import json
+import random
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+from flask import (Blueprint, abort, before_render_template, g, has_request_context, jsonify,
+                   request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# OTLP span kinds and status codes
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_OK, STATUS_ERROR = 1, 2
+
+MAX_STATEMENT_LENGTH = 2000
+
+
+def random_id(size):
+    return '{:0{}x}'.format(random.getrandbits(size * 8) or 1, size * 2)
+
+
+def attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Span(object):
+
+    def __init__(self, trace_id, parent_id, name, kind=INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = random_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end or self.start),
+            'attributes': [{'key': key, 'value': attribute_value(value)}
+                           for key, value in self.attributes.items() if value is not None],
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error is not None:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+
+class Trace(object):
+    """The spans of one request, and the stack of those still open."""
+
+    def __init__(self, trace_id, parent_id=None):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.spans = []
+        self.open = []
+
+    def start(self, name, kind=INTERNAL, attributes=None):
+        parent_id = self.open[-1].span_id if self.open else self.parent_id
+        span = Span(self.trace_id, parent_id, name, kind, attributes)
+        self.spans.append(span)
+        self.open.append(span)
+        return span
+
+    def finish(self, span, error=None):
+        if span.end is not None:
+            return
+        span.end = time.time_ns()
+        if error is not None:
+            span.error = error if isinstance(error, str) else '{}: {}'.format(
+                type(error).__name__, error)
+        if span in self.open:
+            self.open.remove(span)
+
+    def finish_all(self, error=None):
+        for span in reversed(self.open[:]):
+            self.finish(span, error)
+
+
+def current_trace():
+    return g.get('trace') if has_request_context() else None
+
+
+def connection_trace(conn):
+    # the request's trace; asgi.py hangs its own on the connection
+    return current_trace() if has_request_context() else conn.info.get('trace')
+
+
+@contextmanager
+def span(name, **attributes):
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    current = trace.start(name, attributes=attributes)
+    try:
+        yield current
+    except Exception as error:
+        trace.finish(current, error)
+        raise
+    trace.finish(current)
+
+
+def traced(name=None, attributes=None):
+    """Decorator: run the function inside a span, named after it unless
+    `name` is given; `attributes` maps the call's arguments to span
+    attributes."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if current_trace() is None:
+                return function(*args, **kwargs)
+            with span(span_name, **(attributes(*args, **kwargs) if attributes else {})):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def otlp(service_name, spans):
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': attribute_value(service_name)}]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [span.to_otlp() for span in spans],
+        }],
+    }]}
+
+
+class FileExporter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    def export(self, service_name, spans):
+        line = json.dumps(otlp(service_name, spans), separators=(',', ':'))
+        with self._lock, open(self.path, 'a') as out:
+            out.write(line + '\n')
+
+
+class MemoryExporter(object):
+    """Keeps the last `size` traces of this worker."""
+
+    def __init__(self, size=100):
+        self.traces = deque(maxlen=size)
+        self.service_name = None
+
+    def export(self, service_name, spans):
+        self.service_name = service_name
+        self.traces.append(spans)
+
+    def to_otlp(self):
+        return otlp(self.service_name, [span for spans in list(self.traces) for span in spans])
+
+
+class Tracer(object):
+
+    def __init__(self, app=None, db=None, authorize=None):
+        if app is not None:
+            self.init_app(app, db, authorize)
+
+    def init_app(self, app, db=None, authorize=None):
+        config = app.config
+        self.authorize = authorize
+        self.enabled = config.get('TRACING', False)
+        self.sample_rate = config.get('TRACING_SAMPLE_RATE', 0.0)
+        self.service_name = config.get('TRACING_SERVICE_NAME', app.name)
+        if config.get('TRACING_EXPORTER', 'file') == 'memory':
+            self.exporter = MemoryExporter(config.get('TRACING_MEMORY_SIZE', 100))
+            bp = Blueprint('traces', __name__)
+            bp.before_request(self.check_authorized)
+            bp.add_url_rule('/traces', 'recent', self.recent_traces)
+            app.register_blueprint(bp)
+        else:
+            self.exporter = FileExporter(config.get('TRACING_FILE', 'traces.ndjson'))
+        if not self.enabled:
+            return
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.export)
+        before_render_template.connect(self.template_started, app)
+        template_rendered.connect(self.template_finished, app)
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'handle_error', self.handle_error)
+        if db is not None:
+            event.listen(db.session, 'before_commit', self.commit_started)
+            event.listen(db.session, 'after_commit', self.commit_finished)
+            event.listen(db.session, 'after_soft_rollback', self.commit_failed)
+
+        # the view runs in dispatch_request, after the before_request functions
+        dispatch_request = app.dispatch_request
+
+        def traced_dispatch_request():
+            with span('view ' + (request.endpoint or 'unmatched')):
+                return dispatch_request()
+        app.dispatch_request = traced_dispatch_request
+
+    def sampled(self, traceparent):
+        """(trace_id, parent_id) for a request to trace, or None."""
+        match = TRACEPARENT.match(traceparent or '')
+        if match and match.group(1) != '0' * 32 and match.group(2) != '0' * 16:
+            trace_id, parent_id, flags = match.groups()
+            return (trace_id, parent_id) if int(flags, 16) & 1 else None
+        if self.sample_rate and random.random() < self.sample_rate:
+            return random_id(16), None
+        return None
+
+    def start(self):
+        rule = request.url_rule.rule if request.url_rule else request.path
+        trace = self.start_trace(request.headers.get('traceparent'), request.method, rule,
+                                 request.full_path.rstrip('?'), request.user_agent.string)
+        if trace is not None:
+            g.trace = trace
+
+    def finish(self, response):
+        trace = current_trace()
+        if trace is not None:
+            response.headers['traceparent'] = self.set_status(trace, response.status_code)
+        return response
+
+    def export(self, exception=None):
+        trace = g.pop('trace', None)
+        if trace is not None:
+            self.export_trace(trace, exception)
+
+    # the request-level steps, shared with the API reads asgi.py answers
+
+    def start_trace(self, traceparent, method, route, target, user_agent=None):
+        """The trace of a sampled request, with its server span open, or None."""
+        sampled = self.sampled(traceparent)
+        if sampled is None:
+            return None
+        trace = Trace(*sampled)
+        trace.start('{} {}'.format(method, route), SERVER, {
+            'http.method': method,
+            'http.route': route,
+            'http.target': target,
+            'http.user_agent': user_agent or None,
+        })
+        return trace
+
+    def set_status(self, trace, status):
+        """Record the response status; the traceparent header to send back."""
+        root = trace.spans[0]
+        root.attributes['http.status_code'] = status
+        if status >= 500:
+            root.error = str(status)
+        return '00-{}-{}-01'.format(trace.trace_id, root.span_id)
+
+    def export_trace(self, trace, error=None):
+        trace.finish_all(error)
+        self.exporter.export(self.service_name, trace.spans)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        trace = connection_trace(conn)
+        if trace is not None:
+            words = statement.split(None, 1)
+            conn.info.setdefault('trace_spans', []).append(trace.start(
+                words[0].upper() if words else 'SQL', CLIENT, {
+                    'db.system': conn.dialect.name,
+                    'db.statement': statement[:MAX_STATEMENT_LENGTH],
+                    'db.executemany': executemany or None,
+                }))
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get('trace_spans')
+        trace = connection_trace(conn)
+        if spans and trace is not None:
+            trace.finish(spans.pop())
+
+    def handle_error(self, context):
+        conn = context.connection
+        spans = conn.info.get('trace_spans') if conn is not None else None
+        trace = connection_trace(conn) if conn is not None else None
+        if spans and trace is not None:
+            trace.finish(spans.pop(), context.original_exception)
+
+    def commit_started(self, session):
+        trace = current_trace()
+        if trace is not None:
+            session.info['trace_commit'] = trace.start('commit')
+
+    def commit_finished(self, session):
+        commit = session.info.pop('trace_commit', None)
+        trace = current_trace()
+        if commit is not None and trace is not None:
+            trace.finish(commit)
+
+    def commit_failed(self, session, previous_transaction):
+        commit = session.info.pop('trace_commit', None)
+        trace = current_trace()
+        if commit is not None and trace is not None:
+            trace.finish(commit, 'rolled back')
+
+    def template_started(self, app, template, context, **extra):
+        trace = current_trace()
+        if trace is not None:
+            trace.start('render ' + (template.name or 'string'))
+
+    def template_finished(self, app, template, context, **extra):
+        trace = current_trace()
+        if trace is not None and trace.open:
+            trace.finish(trace.open[-1])
+
+    def check_authorized(self):
+        if self.authorize is None or not self.authorize():
+            abort(403)
+
+    def recent_traces(self):
+        return jsonify(self.exporter.to_otlp())